@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+# Per-call metrics from every button and the server go to one local SQLite store;
+# run any of the buttons with --report to summarise them
+METRICS_DB_FILE = "metrics.db"
+API_KEY_FILE = "api_key.json"
+
+# api_key.json may list several keys. Each key is paced at its own requests-per-minute, and a request goes
+# to whichever key frees up first. These limits are assumed for a key until its first response reports the real ones.
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 30000
+RATE_LIMIT_COOLDOWN = 20  # seconds, for 429s that arrive without reset headers
+# USD per 1K prompt/completion tokens, and per image by (model, quality, size)
+CHAT_PRICES = {
+    "gpt-4": (0.03, 0.06),
+}
+IMAGE_PRICES = {
+    ("dall-e-3", "standard", "1024x1024"): 0.04,
+    ("dall-e-3", "standard", "1024x1792"): 0.08,
+    ("dall-e-3", "standard", "1792x1024"): 0.08,
+    ("dall-e-3", "hd", "1024x1024"): 0.08,
+    ("dall-e-3", "hd", "1024x1792"): 0.12,
+    ("dall-e-3", "hd", "1792x1024"): 0.12,
+}
+
+def call_cost(model, usage=None, image_size=None, image_quality=None, cache_hit=False, error=None):
+    usage = usage or {}
+    if cache_hit:
+        return 0.0
+    if model in CHAT_PRICES:
+        prompt_price, completion_price = CHAT_PRICES[model]
+        return (usage.get("prompt_tokens", 0) * prompt_price + usage.get("completion_tokens", 0) * completion_price) / 1000
+    if error is None:
+        return IMAGE_PRICES.get((model, image_quality, image_size), 0.0)
+    return 0.0
+
+class MetricsStore:
+    def __init__(self, path=METRICS_DB_FILE):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    recorded_at REAL NOT NULL,
+                    run_id TEXT NOT NULL,
+                    button TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    latency_ms REAL NOT NULL,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    total_tokens INTEGER,
+                    image_size TEXT,
+                    image_quality TEXT,
+                    retries INTEGER NOT NULL DEFAULT 0,
+                    cache_hit INTEGER NOT NULL DEFAULT 0,
+                    succeeded INTEGER NOT NULL,
+                    error TEXT,
+                    cost_usd REAL NOT NULL DEFAULT 0
+                )
+            """)
+
+    @contextmanager
+    def connect(self):
+        # One short-lived connection per call keeps the store safe to use from any worker thread;
+        # the inner block commits and the outer one closes, since sqlite3's own context manager never closes
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection, connection:
+            yield connection
+
+    def record(self, run_id, button, stage, model, latency_ms, usage=None, image_size=None, image_quality=None, retries=0, cache_hit=False, error=None):
+        usage = usage or {}
+        cost = call_cost(model, usage, image_size, image_quality, cache_hit, error)
+        # sqlite3.Error is left to the caller, which reports it on its own progress channel
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO calls (recorded_at, run_id, button, stage, model, latency_ms, prompt_tokens, completion_tokens, total_tokens,"
+                " image_size, image_quality, retries, cache_hit, succeeded, error, cost_usd) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), run_id, button, stage, model, latency_ms, usage.get("prompt_tokens"), usage.get("completion_tokens"), usage.get("total_tokens"),
+                 image_size, image_quality, retries, int(cache_hit), int(error is None), error, cost)
+            )
+
+    def report(self):
+        with self.connect() as connection:
+            rows = connection.execute("SELECT stage, model, latency_ms FROM calls WHERE succeeded = 1 AND cache_hit = 0 ORDER BY stage, model, latency_ms").fetchall()
+            throughput = connection.execute(
+                "SELECT date(recorded_at, 'unixepoch', 'localtime') AS day, COUNT(*), COUNT(DISTINCT run_id), SUM(1 - succeeded)"
+                " FROM calls GROUP BY day ORDER BY day"
+            ).fetchall()
+            spend = connection.execute(
+                "SELECT button, COUNT(DISTINCT run_id), SUM(cost_usd), SUM(total_tokens), SUM(cache_hit), COUNT(*)"
+                " FROM calls GROUP BY button ORDER BY button"
+            ).fetchall()
+
+        latencies = {}
+        for stage, model, latency_ms in rows:
+            latencies.setdefault((stage, model), []).append(latency_ms)
+
+        def percentile(values, p):
+            # Nearest-rank percentile over already sorted values
+            return values[max(0, -(-len(values) * p // 100) - 1)]
+
+        report = "Latency per stage and model (ms)\n"
+        report += f"{'Stage':<28}{'Model':<12}{'Calls':>7}{'p50':>10}{'p95':>10}{'p99':>10}\n"
+        for (stage, model), values in latencies.items():
+            report += f"{stage:<28}{model:<12}{len(values):>7}{percentile(values, 50):>10.0f}{percentile(values, 95):>10.0f}{percentile(values, 99):>10.0f}\n"
+
+        report += "\nThroughput per day\n"
+        report += f"{'Day':<14}{'Calls':>7}{'Bundles':>9}{'Failed':>8}\n"
+        for day, calls, bundles, failed in throughput:
+            report += f"{day:<14}{calls:>7}{bundles:>9}{failed:>8}\n"
+
+        report += "\nSpend per bundle type (estimated)\n"
+        report += f"{'Button':<22}{'Bundles':>9}{'Total $':>10}{'$/bundle':>10}{'Tokens':>10}{'Cache hits':>12}\n"
+        for button, bundles, cost, tokens, cache_hits, calls in spend:
+            report += f"{button:<22}{bundles:>9}{cost:>10.2f}{cost / bundles:>10.2f}{tokens or 0:>10}{f'{cache_hits}/{calls}':>12}\n"
+        return report
+
+class GenerationError(Exception):
+    pass
+
+class Credential:
+    def __init__(self, api_key, organization=None, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        if organization:
+            self.headers["OpenAI-Organization"] = organization
+        self.name = f"...{api_key[-4:]}" + (f" ({organization})" if organization else "")
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.remaining_requests = requests_per_minute
+        self.remaining_tokens = tokens_per_minute
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.next_slot = 0.0
+        self.disabled = None
+
+    def headroom(self, now):
+        # Start a fresh one-minute window once the last reported reset has passed
+        if now >= self.requests_reset_at:
+            self.remaining_requests = self.requests_per_minute
+            self.requests_reset_at = now + 60
+        if now >= self.tokens_reset_at:
+            self.remaining_tokens = self.tokens_per_minute
+            self.tokens_reset_at = now + 60
+        return min(self.remaining_requests / self.requests_per_minute, self.remaining_tokens / self.tokens_per_minute)
+
+    def ready_at(self):
+        # The key's next paced slot, pushed back to the window reset once its reported budget runs out
+        ready = self.next_slot
+        if self.remaining_requests <= 0:
+            ready = max(ready, self.requests_reset_at)
+        if self.remaining_tokens <= 0:
+            ready = max(ready, self.tokens_reset_at)
+        return ready
+
+class CredentialPool:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Returns a key whose slot is free now, or None and how long until the soonest one frees up
+        with self.lock:
+            now = time.monotonic()
+            usable = [credential for credential in self.credentials if not credential.disabled]
+            if not usable:
+                reasons = "; ".join(f"{credential.name}: {credential.disabled}" for credential in self.credentials)
+                raise GenerationError(f"No usable API keys left ({reasons}).")
+            credential = min(usable, key=lambda credential: (max(credential.ready_at(), now), -credential.headroom(now)))
+            wait = credential.ready_at() - now
+            if wait > 0:
+                return None, wait
+            credential.next_slot = max(now, credential.next_slot) + 60 / credential.requests_per_minute
+            # Count the request up front so concurrent callers spread across keys before any headers arrive
+            credential.remaining_requests -= 1
+            return credential, 0
+
+    def acquire(self):
+        # Blocking form of reserve for the desktop worker threads
+        while True:
+            credential, wait = self.reserve()
+            if credential:
+                return credential
+            time.sleep(wait)
+
+    def release(self, credential, status=None, headers=None, error_code=None):
+        with self.lock:
+            now = time.monotonic()
+            if status in (401, 403):
+                credential.disabled = "authentication failed"
+            elif status == 429 and error_code == "insufficient_quota":
+                credential.disabled = "quota exhausted"
+            elif status == 429:
+                credential.remaining_requests = 0
+                credential.requests_reset_at = now + RATE_LIMIT_COOLDOWN
+            if not headers:
+                return
+            # OpenAI reports the remaining budget and time to reset on every response
+            for limit, remaining, reset in (("requests", "remaining_requests", "requests_reset_at"), ("tokens", "remaining_tokens", "tokens_reset_at")):
+                if f"x-ratelimit-limit-{limit}" in headers:
+                    setattr(credential, f"{limit}_per_minute", max(1, int(headers[f"x-ratelimit-limit-{limit}"])))
+                if f"x-ratelimit-remaining-{limit}" in headers:
+                    setattr(credential, remaining, int(headers[f"x-ratelimit-remaining-{limit}"]))
+                if f"x-ratelimit-reset-{limit}" in headers:
+                    setattr(credential, reset, now + parse_reset_duration(headers[f"x-ratelimit-reset-{limit}"]))
+
+def parse_reset_duration(value):
+    # Durations look like "20ms", "1s" or "6m0s"
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value))
+
+def load_credential_pool(path=API_KEY_FILE):
+    # api_key.json holds either {"api_key": ...} or {"keys": [{"api_key": ..., "organization": ...,
+    # "requests_per_minute": ..., "tokens_per_minute": ...}, ...]}
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        data = json.load(file)
+    keys = data.get("keys") or ([{"api_key": data["api_key"]}] if data.get("api_key") else [])
+    if not keys:
+        return None
+    return CredentialPool([Credential(**key) for key in keys])
@@ -0,0 +1,946 @@
+import sys
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+import asyncio
+import argparse
+import zipfile
+import multiprocessing
+from collections import OrderedDict
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import aiohttp
+from aiohttp import web
+from PIL import Image, ImageDraw
+import pandas as pd
+from openpyxl import Workbook
+from MagicButtonsCommon import API_KEY_FILE, Credential, CredentialPool, GenerationError, MetricsStore, load_credential_pool
+
+# OpenAI and DALL-E setup
+CHAT_API_URL = "https://api.openai.com/v1/chat/completions"
+DALLE_API_URL = "https://api.openai.com/v1/images/generations"
+CHAT_MODEL = "gpt-4"
+
+# Server setup. Every client shares one connection pool, response cache and key pool,
+# and each in-flight API call is a coroutine rather than a thread.
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+MAX_CONNECTIONS = 100
+MAX_IN_FLIGHT_REQUESTS = 200
+REQUEST_TIMEOUT = 300  # seconds
+CACHE_MAX_ENTRIES = 512
+JOB_RETENTION_SECONDS = 3600
+BUTTONS = ["marketing campaign", "game plan", "comic book"]
+
+CONCEPT_PROMPTS = {
+    "marketing campaign": "Create a detailed marketing campaign concept based on the following prompt: {user_prompt}.",
+    "game plan": "Invent a new 2D game concept with a detailed theme, setting, and unique features based on the following prompt: {user_prompt}. Ensure the game has WASD controls.",
+    "comic book": "Create a detailed comic book concept based on the following prompt: {user_prompt}.",
+}
+
+# Jobs posted with "draft": true render every image at the cheapest quality and smallest DALL-E 3 size
+DRAFT_IMAGE_SIZE = "1024x1024"
+DRAFT_IMAGE_QUALITY = "standard"
+FINAL_IMAGE_QUALITY = "hd"
+
+# Social media schedule: SCHEDULE_WEEKS weeks starting tomorrow, with SCHEDULE_CADENCE posts per week
+# on each platform, unless a job's "schedule" object says otherwise. Posts are written SCHEDULE_BATCH_SIZE
+# at a time by structured (JSON) completions.
+SCHEDULE_PLATFORMS = ["Twitter", "Facebook", "Instagram", "LinkedIn"]
+SCHEDULE_WEEKS = 4
+SCHEDULE_CADENCE = {"Twitter": 5, "Facebook": 3, "Instagram": 4, "LinkedIn": 2}
+SCHEDULE_POST_TIMES = {"Twitter": ["09:00", "12:30", "17:00"], "Facebook": ["13:00", "19:00"], "Instagram": ["11:00", "19:30"], "LinkedIn": ["08:30", "12:00"]}
+SCHEDULE_MAX_WEEKS = 13
+SCHEDULE_MAX_POSTS_PER_WEEK = 21
+SCHEDULE_BATCH_SIZE = 40
+SCHEDULE_BATCH_RETRIES = 2  # per batch, so one malformed reply does not rewrite the whole schedule
+SCHEDULE_PROMPT = (
+    "Write social media posts for the marketing campaign below, one for each numbered slot. Fit each post to its platform's "
+    "usual length and tone, vary the angle from post to post, and do not repeat the campaign description verbatim. "
+    'Respond with only a JSON object of the form {{"posts": [{{"id": 1, "post": "...", "hashtags": "#tag #tag"}}]}}.'
+    "\n\nCampaign:\n{campaign_concept}\n\nSlots (id | platform | date | time):\n{slots}"
+)
+
+# Per-stage failure policy: (retries, then "skip" the stage or "abort" the run without producing a bundle).
+# Stages that consume a failed stage's output are skipped rather than fed an error.
+STAGE_POLICIES = {
+    "campaign_concept": (2, "abort"),
+    "game_concept": (2, "abort"),
+    "comic_concept": (2, "abort"),
+    "world_concept": (2, "skip"),
+    "character_concepts": (2, "skip"),
+    "images": (0, "skip"),
+    "unity_scripts": (0, "skip"),
+    "character_designs": (0, "skip"),
+    "comic_panels": (0, "skip"),
+    "cover_page": (0, "skip"),
+    "pages": (0, "skip"),
+    "social_media_schedule": (0, "skip"),
+}
+DEFAULT_STAGE_POLICY = (1, "skip")
+STAGE_RETRY_DELAY = 2  # seconds, multiplied by the attempt number
+
+# Unity scripts are requested concurrently and deduplicated by content; repeats hit the shared response cache
+UNITY_SCRIPT_PROMPT = "{description}. Respond with one complete C# MonoBehaviour script in a single ```csharp code block."
+# C# comments and string/char literals, so a class rename only touches the identifiers outside them (group 1)
+CSHARP_TOKEN_PATTERN = re.compile(r'''//[^\n]*|/\*.*?\*/|(?:\$@|@\$?)"(?:[^"]|"")*"|\$?"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|\b(\w+)\b''', re.S)
+
+# Page compositor layout, in pixels (US comic trim at 150 dpi)
+PAGE_LAYOUT = {
+    "page_size": (994, 1538),
+    "rows": 2,
+    "columns": 2,
+    "margin": 48,
+    "gutter": 24,
+    "border": 4,
+    "background": "white",
+    "border_color": "black",
+}
+PAGE_EXPORT_FORMATS = ["pdf", "cbz"]
+COMPOSITOR_WORKERS = None  # None uses one process per CPU
+# Each image group is generated from the same four prompts (character, two scenes, cover), so only
+# the scene shots are laid out as panels and the cover prompt's image is preferred for the cover
+PANEL_IMAGES = ["image_2.png", "image_3.png"]
+COVER_IMAGE = "image_4.png"
+
+def render_comic_page(panel_images, layout):
+    # Runs in a worker process, so it only takes and returns plain bytes and dicts
+    page_width, page_height = layout["page_size"]
+    rows, columns = layout["rows"], layout["columns"]
+    margin, gutter, border = layout["margin"], layout["gutter"], layout["border"]
+    cell_width = (page_width - 2 * margin - (columns - 1) * gutter) // columns
+    cell_height = (page_height - 2 * margin - (rows - 1) * gutter) // rows
+    inner_width, inner_height = cell_width - 2 * border, cell_height - 2 * border
+
+    page = Image.new("RGB", (page_width, page_height), layout["background"])
+    draw = ImageDraw.Draw(page)
+    for index, panel_data in enumerate(panel_images[:rows * columns]):
+        row, column = divmod(index, columns)
+        x = margin + column * (cell_width + gutter)
+        y = margin + row * (cell_height + gutter)
+        if border:
+            draw.rectangle([x, y, x + cell_width - 1, y + cell_height - 1], fill=layout["border_color"])
+
+        with Image.open(BytesIO(panel_data)) as panel:
+            # Crop to the cell's aspect ratio and scale in a single resize, without an intermediate copy
+            scale = max(inner_width / panel.width, inner_height / panel.height)
+            crop_width, crop_height = inner_width / scale, inner_height / scale
+            left, top = (panel.width - crop_width) / 2, (panel.height - crop_height) / 2
+            fitted = panel.resize((inner_width, inner_height), Image.LANCZOS, box=(left, top, left + crop_width, top + crop_height), reducing_gap=2.0)
+        page.paste(fitted, (x + border, y + border))
+
+    page_buffer = BytesIO()
+    page.save(page_buffer, "PNG")
+    return page_buffer.getvalue()
+
+class StageAborted(Exception):
+    def __init__(self, stage, reason):
+        super().__init__(f"{stage.replace('_', ' ')} failed: {reason}")
+        self.stage = stage
+
+
+class RateLimiter:
+    # Yields the API key to send with. The key is only picked once one has a free slot,
+    # so the headroom it was chosen on is current when the request goes out.
+    def __init__(self, credentials, max_in_flight):
+        self.credentials = credentials
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def __aenter__(self):
+        await self.in_flight.acquire()
+        try:
+            while True:
+                credential, wait = self.credentials.reserve()
+                if credential:
+                    return credential
+                await asyncio.sleep(wait)
+        except BaseException:
+            # A request cancelled while it waits for its slot never reaches __aexit__
+            self.in_flight.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight.release()
+
+class ResponseCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class GenerationEngine:
+    def __init__(self, credentials, metrics=None):
+        self.credentials = credentials
+        self.metrics = metrics
+        self.limiter = None
+        self.cache = ResponseCache(CACHE_MAX_ENTRIES)
+        self.session = None
+        self.page_pool = None
+
+    async def start(self, app):
+        self.limiter = RateLimiter(self.credentials, MAX_IN_FLIGHT_REQUESTS)
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        self.page_pool = self.create_page_pool()
+
+    def create_page_pool(self):
+        return ProcessPoolExecutor(max_workers=COMPOSITOR_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+    def reset_page_pool(self, broken):
+        # A worker that dies takes the whole pool down with it, so later jobs get a fresh one
+        if self.page_pool is broken:
+            self.page_pool = self.create_page_pool()
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    async def close(self, app):
+        await self.session.close()
+        # Shutting the pool down joins its worker processes, so it must not block the event loop
+        await asyncio.to_thread(self.page_pool.shutdown, cancel_futures=True)
+
+    async def chat(self, job, stage, system, prompt, use_cache=True):
+        cache_key = (CHAT_MODEL, system, prompt)
+        started = time.perf_counter()
+        cached = self.cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            await job.record_call(stage, CHAT_MODEL, started, cache_hit=True)
+            return cached
+
+        data = {
+            "model": CHAT_MODEL,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": prompt}
+            ]
+        }
+        credential = None
+        status, headers, error_code = None, None, None
+        try:
+            async with self.limiter as credential:
+                async with self.session.post(CHAT_API_URL, headers=credential.headers, json=data) as response:
+                    status, headers = response.status, response.headers
+                    response_data = await response.json(content_type=None)
+            if "choices" not in response_data:
+                error = response_data.get("error") or {}
+                error_code = error.get("code")
+                await job.record_call(stage, CHAT_MODEL, started, error=error.get("message", "Unknown error"))
+                raise GenerationError(error.get("message", "Unknown error"))
+            content_text = response_data["choices"][0]["message"]["content"]
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            await job.record_call(stage, CHAT_MODEL, started, error=str(e) or type(e).__name__)
+            raise GenerationError(f"Unable to communicate with the OpenAI API: {e}")
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            # A reply without the expected fields fails the call like any other API error, so run_stage applies the stage policy
+            await job.record_call(stage, CHAT_MODEL, started, error=f"Malformed response: {e!r}")
+            raise GenerationError(f"Malformed response from the OpenAI API: {e!r}")
+        finally:
+            if credential:
+                self.credentials.release(credential, status, headers, error_code)
+
+        await job.record_call(stage, CHAT_MODEL, started, usage=response_data.get("usage"))
+        self.cache.put(cache_key, content_text)
+        return content_text
+
+    async def image(self, job, stage, prompt, size, quality):
+        data = {
+            "model": "dall-e-3",
+            "prompt": prompt,
+            "n": 1,
+            "size": size,
+            "quality": quality,
+            "style": "vivid",
+            "response_format": "url"
+        }
+        started = time.perf_counter()
+        credential = None
+        status, headers, error_code = None, None, None
+        try:
+            async with self.limiter as credential:
+                async with self.session.post(DALLE_API_URL, headers=credential.headers, json=data) as response:
+                    status, headers = response.status, response.headers
+                    response_data = await response.json(content_type=None)
+            if "data" not in response_data:
+                error = response_data.get("error") or {}
+                error_code = error.get("code")
+                await job.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=error.get("message", "Unknown error"))
+                return b""
+            image_url = response_data['data'][0]['url']
+            await job.record_call(stage, data["model"], started, image_size=size, image_quality=quality)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            await job.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=str(e) or type(e).__name__)
+            return b""
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            job.emit(None, f"Malformed image response for {stage.replace('_', ' ')}: {e!r}")
+            await job.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=f"Malformed response: {e!r}")
+            return b""
+        finally:
+            if credential:
+                self.credentials.release(credential, status, headers, error_code)
+
+        try:
+            async with self.session.get(image_url) as response:
+                response.raise_for_status()
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            job.emit(None, f"Error downloading image for {stage.replace('_', ' ')}: {str(e)}")
+            return b""
+
+class BundleJob:
+    def __init__(self, engine, button, prompt, draft=False, schedule=None):
+        self.engine = engine
+        self.id = uuid.uuid4().hex
+        self.button = button
+        self.prompt = prompt
+        self.draft = draft
+        self.schedule = schedule or parse_schedule_options({})
+        self.status = "running"
+        self.created_at = time.time()
+        self.events = []
+        self.changed = asyncio.Event()
+        self.failures = {}
+        self.bundle = None
+        # Draft images by (stage, file name) -> (prompt, full size), until they are refined
+        self.image_requests = {}
+        self.zip_data = None
+        self.filename = None
+
+    def emit(self, progress, message, event="progress"):
+        self.events.append({"event": event, "progress": progress, "message": message})
+        # Wake every stream waiting on the current event; later waiters get a fresh one
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def stream_events(self, since=0):
+        index = since
+        while True:
+            while index >= len(self.events) and self.status == "running":
+                await self.changed.wait()
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.status != "running":
+                return
+
+    async def record_call(self, stage, model, started, usage=None, image_size=None, image_quality=None, retries=0, cache_hit=False, error=None):
+        if self.engine.metrics:
+            latency_ms = (time.perf_counter() - started) * 1000
+            try:
+                await asyncio.to_thread(self.engine.metrics.record, self.id, self.button, stage, model, latency_ms, usage, image_size, image_quality, retries, cache_hit, error)
+            except sqlite3.Error as e:
+                self.emit(None, f"Could not record metrics: {str(e)}")
+
+    async def run(self):
+        generate = {
+            "marketing campaign": self.generate_marketing_campaign,
+            "game plan": self.generate_game_plan,
+            "comic book": self.generate_comic_book,
+        }[self.button]
+        try:
+            result = await generate()
+            if isinstance(result, dict):
+                self.bundle = result
+                self.zip_data = await asyncio.to_thread(create_zip, result)
+                self.filename = f"{self.button}_partial.zip" if self.failures else f"{self.button}.zip"
+                self.status = "done"
+                self.emit(100, f"{self.filename} ready.", event="done")
+            else:
+                self.status = "failed"
+                self.emit(100, result, event="failed")
+        except Exception as e:
+            self.status = "failed"
+            self.emit(100, f"Error: {str(e)}", event="failed")
+
+    async def refine(self, selected):
+        # Regenerates the selected draft images in HD at full size, then recomposes and re-zips the bundle
+        try:
+            async def regenerate(stage, name):
+                prompt, size = self.image_requests[(stage, name)]
+                image_data = await self.engine.image(self, f"refine_{stage}", prompt, size, FINAL_IMAGE_QUALITY)
+                if image_data:
+                    self.bundle[stage][name] = image_data
+                    del self.image_requests[(stage, name)]
+                    self.emit(None, f"Refined {stage}/{name}")
+                else:
+                    self.emit(None, f"Could not refine {stage}/{name}, keeping the draft.")
+
+            self.emit(10, f"Refining {len(selected)} images in HD...")
+            await asyncio.gather(*(regenerate(stage, name) for stage, name in selected))
+
+            if 'pages' in self.bundle:
+                self.emit(80, "Recomposing pages...")
+                try:
+                    self.bundle['pages'] = await self.compose_pages("pages", self.bundle)
+                except GenerationError as e:
+                    self.emit(None, f"Could not recompose pages, keeping the draft pages: {str(e)}")
+
+            self.emit(90, "Packaging into ZIP...")
+            self.zip_data = await asyncio.to_thread(create_zip, self.bundle)
+            self.status = "done"
+            self.emit(100, f"{self.filename} ready.", event="done")
+        except Exception as e:
+            self.status = "failed"
+            self.emit(100, f"Error: {str(e)}", event="failed")
+
+    async def run_stage(self, bundle, stage, generate, *args, requires=()):
+        # Stages never run on the output of a failed stage; see STAGE_POLICIES for retry/skip/abort
+        failed_inputs = [name for name in requires if name in self.failures]
+        if failed_inputs:
+            self.failures[stage] = f"Skipped because {', '.join(failed_inputs)} failed."
+            return None
+
+        retries, on_failure = STAGE_POLICIES.get(stage, DEFAULT_STAGE_POLICY)
+        for attempt in range(retries + 1):
+            try:
+                bundle[stage] = await generate(stage, *args)
+                return bundle[stage]
+            except GenerationError as e:
+                error = e
+                if attempt < retries:
+                    await asyncio.sleep(STAGE_RETRY_DELAY * (attempt + 1))
+
+        self.failures[stage] = str(error)
+        self.emit(None, f"{stage.replace('_', ' ').capitalize()} failed: {str(error)}")
+        if on_failure == "abort":
+            raise StageAborted(stage, str(error))
+        return None
+
+    async def run_stages(self, bundle, *stages):
+        # Independent stages run concurrently; each entry is (stage, generate, args, requires)
+        await asyncio.gather(*(self.run_stage(bundle, stage, generate, *args, requires=requires) for stage, generate, args, requires in stages))
+
+    async def generate_content(self, stage, prompt, use_cache=True):
+        return await self.engine.chat(self, stage, f"You are a helpful assistant specializing in {self.button}.", prompt, use_cache)
+
+    async def generate_concept(self, stage, user_prompt):
+        return await self.generate_content(stage, CONCEPT_PROMPTS[self.button].format(user_prompt=user_prompt))
+
+    async def generate_image_set(self, stage, prompts):
+        # prompts maps file name -> (prompt, full size)
+        async def generate(name, prompt, size):
+            if self.draft:
+                self.image_requests[(stage, name)] = (prompt, size)
+                return await self.engine.image(self, stage, prompt, DRAFT_IMAGE_SIZE, DRAFT_IMAGE_QUALITY)
+            return await self.engine.image(self, stage, prompt, size, FINAL_IMAGE_QUALITY)
+
+        results = await asyncio.gather(*(generate(name, prompt, size) for name, (prompt, size) in prompts.items()))
+        images = dict(zip(prompts, results))
+        if not any(images.values()):
+            raise GenerationError(f"No images could be generated for the {stage.replace('_', ' ')}.")
+        return images
+
+    def finish(self, bundle, title):
+        if self.failures:
+            bundle['failures'] = "\n".join(f"{stage.replace('_', ' ').capitalize()}: {reason}" for stage, reason in self.failures.items())
+        bundle['master_document'] = create_master_document(title, bundle)
+        self.emit(90, "Packaging into ZIP...")
+        return bundle
+
+    async def generate_marketing_campaign(self):
+        campaign_plan = {}
+        try:
+            self.emit(10, "Generating campaign concept...")
+            campaign_concept = await self.run_stage(campaign_plan, "campaign_concept", self.generate_concept, self.prompt)
+
+            campaign_plan['budget_spreadsheet'] = await asyncio.to_thread(generate_budget_spreadsheet)
+
+            self.emit(30, "Generating marketing plan, social media schedule, images, resources and recap...")
+            descriptions = {
+                "banner": ("Wide banner image in a modern and appealing style, with absolutely no font, no words, no text, no characters, no numbers, no letters in the image, matching the theme of: " + campaign_concept, "1792x1024"),
+                "instagram_background": ("Tall background image suitable, with absolutely no font, no words, no text, no characters, no numbers, no letters in the image, for Instagram video, matching the theme of: " + campaign_concept, "1024x1792"),
+                "square_post_1": ("Square background image for social media post, with absolutely no font, no words, no text, no characters, no numbers, no letters in the image, matching the theme of: " + campaign_concept, "1024x1024"),
+                "square_post_2": ("Square background image for social media post, with absolutely no font, no words, no text, no characters, no numbers, no letters in the image, matching the theme of: " + campaign_concept, "1024x1024"),
+                "square_post_3": ("Square background image for social media post, with absolutely no font, no words, no text, no characters, no numbers, no letters in the image, matching the theme of: " + campaign_concept, "1024x1024"),
+            }
+            await self.run_stages(
+                campaign_plan,
+                ("marketing_plan", self.generate_content, (f"Create a detailed marketing plan for the campaign: {campaign_concept}",), ()),
+                ("social_media_schedule", self.generate_social_media_schedule, (campaign_concept, self.schedule["start_date"], self.schedule["weeks"], self.schedule["platforms"], self.schedule["cadence"]), ()),
+                ("images", self.generate_image_set, ({f"{key}.png": value for key, value in descriptions.items()},), ()),
+                ("resources_tips", self.generate_content, (f"List resources and tips for executing the marketing campaign: {campaign_concept}",), ()),
+                ("recap", self.generate_content, (f"Recap the marketing campaign: {campaign_concept}",), ()),
+            )
+
+        except StageAborted as e:
+            return f"Marketing campaign generation stopped: {str(e)}"
+
+        return self.finish(campaign_plan, "Marketing Campaign Master Document")
+
+    async def generate_social_media_schedule(self, stage, campaign_concept, start_date=None, weeks=SCHEDULE_WEEKS, platforms=SCHEDULE_PLATFORMS, cadence=SCHEDULE_CADENCE):
+        slots = build_schedule_slots(start_date or date.today() + timedelta(days=1), weeks, platforms, cadence)
+        if not slots:
+            raise GenerationError("The schedule cadence has no posts to write.")
+        batches = [range(start, min(start + SCHEDULE_BATCH_SIZE, len(slots))) for start in range(0, len(slots), SCHEDULE_BATCH_SIZE)]
+
+        async def write_batch(batch):
+            slot_lines = "\n".join(f"{i + 1} | {slots[i]['Platform']} | {slots[i]['Date']} | {slots[i]['Time']}" for i in batch)
+            prompt = SCHEDULE_PROMPT.format(campaign_concept=campaign_concept, slots=slot_lines)
+            for attempt in range(SCHEDULE_BATCH_RETRIES + 1):
+                try:
+                    # Retries skip the response cache, which still holds the reply that failed to parse
+                    return parse_schedule_batch(await self.generate_content(stage, prompt, use_cache=attempt == 0), [i + 1 for i in batch])
+                except GenerationError as e:
+                    if attempt == SCHEDULE_BATCH_RETRIES:
+                        raise
+                    self.emit(None, f"Retrying schedule slots {batch[0] + 1}-{batch[-1] + 1}: {str(e)}")
+                    await asyncio.sleep(STAGE_RETRY_DELAY * (attempt + 1))
+
+        written = [post for batch_posts in await asyncio.gather(*(write_batch(batch) for batch in batches)) for post in batch_posts]
+        columns = {
+            "Platform": [slot["Platform"] for slot in slots],
+            "Date": [slot["Date"] for slot in slots],
+            "Time": [slot["Time"] for slot in slots],
+            "Post": [post for post, hashtags in written],
+            "Hashtags": [hashtags for post, hashtags in written],
+        }
+        return await asyncio.to_thread(write_schedule_xlsx, columns)
+
+    async def generate_game_plan(self):
+        game_plan = {}
+        try:
+            self.emit(10, "Generating game concept...")
+            game_concept = await self.run_stage(game_plan, "game_concept", self.generate_concept, self.prompt)
+
+            self.emit(20, "Generating world, characters, plot, dialogue and recap...")
+            await self.run_stages(
+                game_plan,
+                ("world_concept", self.generate_content, (f"Create a detailed world concept for the 2D game: {game_concept}",), ()),
+                ("character_concepts", self.generate_content, (f"Create detailed character concepts for the player and enemies in the 2D game: {game_concept}",), ()),
+                ("plot", self.generate_content, (f"Create a plot for the 2D game based on the world and characters of the game: {game_concept}",), ()),
+                ("dialogue", self.generate_content, (f"Write some dialogue for the 2D game based on the plot of the game: {game_concept}",), ()),
+                ("recap", self.generate_content, (f"Recap the game plan for the 2D game: {game_concept}",), ()),
+            )
+
+            self.emit(50, "Generating images and Unity scripts...")
+            character_concepts, world_concept = game_plan.get('character_concepts'), game_plan.get('world_concept')
+            image_descriptions = [
+                f"Full-body, hyper-realistic character for a 2D game, with no background, in Unreal Engine style, based on the character descriptions: {character_concepts}",
+                f"Full-body, hyper-realistic enemy character for a 2D game, with no background, in Unreal Engine style, based on the character descriptions: {character_concepts}",
+                f"High-quality game object for the 2D game, with no background, in Unreal Engine style, based on the world concept: {world_concept}",
+                f"High-quality game object for the 2D game, with no background, in Unreal Engine style, based on the world concept: {world_concept}",
+                f"High-quality game object for the 2D game, with no background, in Unreal Engine style, based on the world concept: {world_concept}",
+                f"High-quality level background for the 2D game, in Unreal Engine style, based on the world concept: {world_concept}"
+            ]
+            script_descriptions = [
+                f"Unity script for the player character in a 2D game with WASD controls and space bar to jump or shoot, based on the character descriptions: {character_concepts}",
+                f"Unity script for an enemy character in a 2D game with basic AI behavior, based on the character descriptions: {character_concepts}",
+                f"Unity script for a collectible pickup game object in a 2D game, based on the world concept: {world_concept}",
+                f"Unity script for a hazard or obstacle game object in a 2D game, based on the world concept: {world_concept}",
+                f"Unity script for an interactive game object such as a door, switch or checkpoint in a 2D game, based on the world concept: {world_concept}",
+                f"Unity script for the level background in a 2D game, based on the world concept: {world_concept}"
+            ]
+            requires = ("character_concepts", "world_concept")
+            await self.run_stages(
+                game_plan,
+                ("images", self.generate_image_set, ({f"image_{i}.png": (desc, "1024x1024") for i, desc in enumerate(image_descriptions, start=1)},), requires),
+                ("unity_scripts", self.generate_unity_scripts, (script_descriptions,), requires),
+            )
+
+        except StageAborted as e:
+            return f"Game plan generation stopped: {str(e)}"
+
+        return self.finish(game_plan, "Game Plan Master Document")
+
+    async def generate_unity_scripts(self, stage, descriptions):
+        async def generate(i, desc):
+            try:
+                content = await self.generate_content(stage, UNITY_SCRIPT_PROMPT.format(description=desc))
+                code = extract_code(content)
+                if code is None:
+                    # Replies without a code block are refusals or prose, not a script to ship as a .cs file
+                    raise GenerationError("Reply had no C# code block.")
+                return code
+            except GenerationError as e:
+                self.emit(None, f"Error generating script {i}: {str(e)}")
+                return None
+
+        results = await asyncio.gather(*(generate(i, desc) for i, desc in enumerate(descriptions, start=1)))
+        scripts = {}
+        digests = set()
+        for i, code in enumerate(results, start=1):
+            if code is None:
+                continue
+            digest = script_digest(code)
+            if digest in digests:
+                self.emit(None, f"Script {i} duplicates an earlier script, skipping it.")
+                continue
+            digests.add(digest)
+            # Stored as bytes so create_zip writes real .cs files
+            file_name, code = name_script(code, i, scripts)
+            scripts[file_name] = code.encode("utf-8")
+        if not scripts:
+            raise GenerationError("No Unity scripts could be generated.")
+        return scripts
+
+    async def generate_comic_book(self):
+        comic_book = {}
+        try:
+            self.emit(10, "Generating comic book concept...")
+            comic_concept = await self.run_stage(comic_book, "comic_concept", self.generate_concept, self.prompt)
+
+            self.emit(20, "Generating plot, character designs, panels, cover and recap...")
+            await self.run_stages(
+                comic_book,
+                ("plot", self.generate_content, (f"Create a detailed plot for the comic book: {comic_concept}",), ()),
+                ("character_designs", self.generate_image_set, (comic_image_prompts(f"Create character designs for the comic book: {comic_concept}"),), ()),
+                ("comic_panels", self.generate_image_set, (comic_image_prompts(f"Create comic panels for the story based on the plot: {comic_concept}"),), ()),
+                ("cover_page", self.generate_image_set, (comic_image_prompts(f"Create a cover page for the comic book: {comic_concept}"),), ()),
+                ("recap", self.generate_content, (f"Recap the comic book content: {comic_concept}",), ()),
+            )
+
+            self.emit(60, "Composing pages...")
+            await self.run_stage(comic_book, "pages", self.compose_pages, comic_book, requires=("comic_panels",))
+
+        except StageAborted as e:
+            return f"Comic book generation stopped: {str(e)}"
+
+        return self.finish(comic_book, "Comic Book Master Document")
+
+    async def compose_pages(self, stage, comic_book):
+        cover_layout = dict(PAGE_LAYOUT, rows=1, columns=1, margin=0, gutter=0, border=0)
+        panels_per_page = PAGE_LAYOUT["rows"] * PAGE_LAYOUT["columns"]
+        cover_images = sorted(comic_book.get('cover_page', {}).items(), key=lambda item: item[0] != COVER_IMAGE)
+        cover = [data for name, data in cover_images if data][:1]
+        panel_images = comic_book.get('comic_panels', {})
+        panels = [panel_images[name] for name in PANEL_IMAGES if panel_images.get(name)]
+
+        page_jobs = {}
+        if cover:
+            page_jobs["page_00_cover.png"] = (cover, cover_layout)
+        for start in range(0, len(panels), panels_per_page):
+            page_jobs[f"page_{len(page_jobs) + 1 - len(cover):02d}.png"] = (panels[start:start + panels_per_page], PAGE_LAYOUT)
+        if not page_jobs:
+            raise GenerationError("No panels to compose.")
+
+        loop = asyncio.get_running_loop()
+        page_pool = self.engine.page_pool
+        try:
+            futures = [loop.run_in_executor(page_pool, render_comic_page, images, layout) for images, layout in page_jobs.values()]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            broken = [result for result in results if isinstance(result, BrokenProcessPool)]
+            if broken:
+                raise broken[0]
+        except (OSError, BrokenProcessPool) as e:
+            self.engine.reset_page_pool(page_pool)
+            raise GenerationError(f"Page compositor failed: {str(e)}")
+        pages = {}
+        for name, result in zip(page_jobs, results):
+            if isinstance(result, Exception):
+                self.emit(None, f"Error composing {name}: {str(result)}")
+            else:
+                pages[name] = result
+                self.emit(None, f"Composed {name}")
+        if not pages:
+            raise GenerationError("No pages could be composed.")
+
+        # The exports sit next to the pages they were built from, under pages/ in the bundle
+        composed = dict(pages)
+        if "pdf" in PAGE_EXPORT_FORMATS:
+            composed['comic.pdf'] = await asyncio.to_thread(export_pdf, pages)
+        if "cbz" in PAGE_EXPORT_FORMATS:
+            composed['comic.cbz'] = await asyncio.to_thread(export_cbz, pages)
+        return composed
+
+def extract_code(content):
+    # The first fenced block of the reply, without the surrounding prose; None if the reply has no code block
+    match = re.search(r"```[\w#+-]*[ \t]*\n(.*?)```", content, re.S)
+    return match.group(1).strip() + "\n" if match else None
+
+def name_script(code, index, taken):
+    # Unity needs a MonoBehaviour's file named after its class, so a class that clashes with an
+    # earlier script is renamed in the code as well as the file name
+    identifiers = [match.group(1) for match in CSHARP_TOKEN_PATTERN.finditer(code) if match.group(1)]
+    class_name = next((name for keyword, name in zip(identifiers, identifiers[1:]) if keyword == "class"), None)
+    if not class_name:
+        return f"script_{index}.cs", code
+    name = class_name
+    while f"{name}.cs" in taken:
+        name = f"{name}{index}"
+    if name != class_name:
+        # Only identifiers are renamed: the declaration, constructors and type uses, never comments or string text
+        code = CSHARP_TOKEN_PATTERN.sub(lambda match: name if match.group(1) == class_name else match.group(0), code)
+    return f"{name}.cs", code
+
+def script_digest(code):
+    # Whitespace-insensitive so the same script with different trailing spaces or line endings dedupes
+    return hashlib.sha256("\n".join(line.rstrip() for line in code.strip().splitlines()).encode("utf-8")).hexdigest()
+
+def comic_image_prompts(description):
+    prompts = [
+        f"Full-body character design for the comic book, based on the following description: {description}",
+        f"Comic panel illustrating a key scene from the comic book, based on the following description: {description}",
+        f"Comic panel illustrating another key scene from the comic book, based on the following description: {description}",
+        f"Cover page for the comic book, based on the following description: {description}"
+    ]
+    return {f"image_{i}.png": (prompt, "1024x1024") for i, prompt in enumerate(prompts, start=1)}
+
+def export_pdf(pages):
+    page_images = [Image.open(BytesIO(data)) for data in pages.values()]
+    pdf_buffer = BytesIO()
+    page_images[0].save(pdf_buffer, "PDF", save_all=True, append_images=page_images[1:], resolution=150)
+    for page_image in page_images:
+        page_image.close()
+    return pdf_buffer.getvalue()
+
+def export_cbz(pages):
+    # Pages are already compressed PNGs, so they are stored rather than deflated again
+    cbz_buffer = BytesIO()
+    with zipfile.ZipFile(cbz_buffer, 'w', zipfile.ZIP_STORED) as cbz_file:
+        for name, data in pages.items():
+            cbz_file.writestr(name, data)
+    return cbz_buffer.getvalue()
+
+def generate_budget_spreadsheet():
+    # Define the budget allocation
+    budget_data = [
+        {"Category": "Advertising", "Amount": 100, "Description": "Social media ads, Google ads"},
+        {"Category": "Content Creation", "Amount": 50, "Description": "Graphics, videos, copywriting"},
+        {"Category": "Social Media", "Amount": 30, "Description": "Scheduling tools, promotion"},
+        {"Category": "Miscellaneous", "Amount": 20, "Description": "Unexpected expenses"}
+    ]
+
+    # Add a summary row for total budget
+    budget_data.append({"Category": "Total", "Amount": sum(item["Amount"] for item in budget_data), "Description": ""})
+
+    # Create a DataFrame from the budget data
+    df = pd.DataFrame(budget_data)
+
+    # Save the DataFrame to an Excel file in memory
+    excel_buffer = BytesIO()
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Budget')
+
+    return excel_buffer.getvalue()
+
+def build_schedule_slots(start_date, weeks, platforms, cadence):
+    slots = []
+    for week in range(weeks):
+        week_start = start_date + timedelta(weeks=week)
+        for platform in platforms:
+            posts_per_week = cadence.get(platform, 0)
+            times = SCHEDULE_POST_TIMES.get(platform, ["12:00"])
+            for i in range(posts_per_week):
+                # Spread the week's posts evenly over its seven days
+                post_date = week_start + timedelta(days=i * 7 // posts_per_week)
+                slots.append({"Platform": platform, "Date": post_date.isoformat(), "Time": times[i % len(times)]})
+    slots.sort(key=lambda slot: (slot["Date"], slot["Time"], slot["Platform"]))
+    return slots
+
+def parse_schedule_options(options):
+    # The optional "schedule" object of a job; anything left out falls back to the SCHEDULE_* defaults
+    if not isinstance(options, dict):
+        raise ValueError("schedule must be a JSON object.")
+    start_date = options.get("start_date")
+    if start_date is not None:
+        try:
+            start_date = date.fromisoformat(start_date)
+        except (TypeError, ValueError):
+            raise ValueError("schedule.start_date must be an ISO date (YYYY-MM-DD).")
+    weeks = options.get("weeks", SCHEDULE_WEEKS)
+    if type(weeks) is not int or not 1 <= weeks <= SCHEDULE_MAX_WEEKS:
+        raise ValueError(f"schedule.weeks must be an integer from 1 to {SCHEDULE_MAX_WEEKS}.")
+    cadence = options.get("cadence", {})
+    if not isinstance(cadence, dict) or any(type(count) is not int or not 0 <= count <= SCHEDULE_MAX_POSTS_PER_WEEK for count in cadence.values()):
+        raise ValueError(f"schedule.cadence must map platform names to 0-{SCHEDULE_MAX_POSTS_PER_WEEK} posts per week.")
+    # Without a platforms list, cadence only adjusts the default platforms or adds new ones
+    platforms = options.get("platforms", SCHEDULE_PLATFORMS + [platform for platform in cadence if platform not in SCHEDULE_PLATFORMS])
+    if not isinstance(platforms, list) or not platforms or not all(isinstance(platform, str) for platform in platforms):
+        raise ValueError("schedule.platforms must be a non-empty list of platform names.")
+    cadence = {platform: cadence.get(platform, SCHEDULE_CADENCE.get(platform)) for platform in platforms}
+    missing = [platform for platform, count in cadence.items() if count is None]
+    if missing:
+        raise ValueError(f"schedule.cadence needs a posts-per-week count for {', '.join(missing)}.")
+    if not any(cadence.values()):
+        raise ValueError("schedule.cadence must schedule at least one post per week.")
+    return {"start_date": start_date, "weeks": weeks, "platforms": platforms, "cadence": cadence}
+
+def parse_schedule_batch(content, slot_ids):
+    start, end = content.find("{"), content.rfind("}")
+    try:
+        posts = json.loads(content[start:end + 1])["posts"]
+        by_id = {int(post["id"]): post for post in posts}
+    except (ValueError, KeyError, TypeError) as e:
+        raise GenerationError(f"Social media schedule batch was not valid JSON: {e}")
+    missing = [slot_id for slot_id in slot_ids if slot_id not in by_id]
+    if missing:
+        raise GenerationError(f"Social media schedule batch is missing {len(missing)} of {len(slot_ids)} posts.")
+    return [(str(by_id[slot_id].get("post", "")), str(by_id[slot_id].get("hashtags", ""))) for slot_id in slot_ids]
+
+def write_schedule_xlsx(columns):
+    # Write-only workbooks stream rows to disk instead of building a cell object per value
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Social Media Schedule")
+    sheet.append(list(columns))
+    for row in zip(*columns.values()):
+        sheet.append(row)
+    excel_buffer = BytesIO()
+    workbook.save(excel_buffer)
+    return excel_buffer.getvalue()
+
+def create_master_document(title, bundle):
+    master_doc = f"{title}\n\n"
+    for key, value in bundle.items():
+        if key == "images":
+            master_doc += f"{key.capitalize()}:\n"
+            for img_key in value:
+                master_doc += f" - {img_key}: See attached image.\n"
+        elif key == "unity_scripts":
+            master_doc += f"{key.replace('_', ' ').capitalize()}:\n"
+            for script_key in value:
+                master_doc += f" - {script_key}: See attached script.\n"
+        else:
+            master_doc += f"{key.replace('_', ' ').capitalize()}: See attached document.\n"
+    return master_doc
+
+def create_zip(content_dict):
+    zip_buffer = BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for key, value in content_dict.items():
+            if isinstance(value, str):
+                zip_file.writestr(f"{key}.txt", value)
+            elif isinstance(value, bytes):
+                zip_file.writestr(key, value)
+            elif isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    if isinstance(sub_value, str):
+                        zip_file.writestr(f"{key}/{sub_key}.txt", sub_value)
+                    elif isinstance(sub_value, bytes):
+                        zip_file.writestr(f"{key}/{sub_key}", sub_value)
+    return zip_buffer.getvalue()
+
+async def handle_create_job(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="Request body must be JSON.")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Request body must be a JSON object.")
+    button = body.get("button")
+    prompt = body.get("prompt", "")
+    if button not in BUTTONS:
+        raise web.HTTPBadRequest(text=f"button must be one of: {', '.join(BUTTONS)}")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise web.HTTPBadRequest(text="prompt must be a non-empty string.")
+    draft = body.get("draft", False)
+    if not isinstance(draft, bool):
+        raise web.HTTPBadRequest(text="draft must be true or false.")
+    try:
+        schedule = parse_schedule_options(body.get("schedule", {}))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    jobs = request.app["jobs"]
+    now = time.time()
+    for job_id in [job_id for job_id, job in jobs.items() if job.status != "running" and now - job.created_at > JOB_RETENTION_SECONDS]:
+        del jobs[job_id]
+
+    job = BundleJob(request.app["engine"], button, prompt, draft=draft, schedule=schedule)
+    jobs[job.id] = job
+    task = asyncio.create_task(job.run())
+    request.app["tasks"].add(task)
+    task.add_done_callback(request.app["tasks"].discard)
+    return web.json_response({"id": job.id, "events": f"/jobs/{job.id}/events", "zip": f"/jobs/{job.id}/zip"}, status=202)
+
+async def handle_refine_job(request):
+    job = get_job(request)
+    if job.status == "running":
+        raise web.HTTPConflict(text="Job is still running.")
+    if job.bundle is None or not job.image_requests:
+        raise web.HTTPConflict(text="Job has no draft images left to refine.")
+    try:
+        body = await request.json() if request.can_read_body else {}
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="Request body must be JSON.")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Request body must be a JSON object.")
+    # "images" lists "stage/file name" paths as they appear in the ZIP; left out, every draft image is refined
+    drafts = {f"{stage}/{name}": (stage, name) for stage, name in job.image_requests}
+    images = body.get("images", list(drafts))
+    if not isinstance(images, list) or not images or not all(isinstance(image, str) for image in images):
+        raise web.HTTPBadRequest(text="images must be a non-empty list of draft image paths.")
+    unknown = [image for image in images if image not in drafts]
+    if unknown:
+        raise web.HTTPBadRequest(text=f"Not draft images of this job: {', '.join(unknown)}")
+
+    since = len(job.events)
+    job.status = "running"
+    task = asyncio.create_task(job.refine([drafts[image] for image in dict.fromkeys(images)]))
+    request.app["tasks"].add(task)
+    task.add_done_callback(request.app["tasks"].discard)
+    return web.json_response({"id": job.id, "events": f"/jobs/{job.id}/events?since={since}", "zip": f"/jobs/{job.id}/zip"}, status=202)
+
+def get_job(request):
+    job = request.app["jobs"].get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(text="Unknown job.")
+    return job
+
+async def handle_job_status(request):
+    job = get_job(request)
+    last_event = job.events[-1] if job.events else None
+    return web.json_response({"id": job.id, "button": job.button, "status": job.status, "last_event": last_event, "failures": job.failures})
+
+async def handle_job_events(request):
+    job = get_job(request)
+    try:
+        since = int(request.query.get("since", 0))
+    except ValueError:
+        raise web.HTTPBadRequest(text="since must be an event index.")
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    async for event in job.stream_events(max(since, 0)):
+        await response.write(f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+    return response
+
+async def handle_job_zip(request):
+    job = get_job(request)
+    if job.status == "running":
+        raise web.HTTPConflict(text="Job is still running.")
+    if job.zip_data is None:
+        raise web.HTTPGone(text=job.events[-1]["message"] if job.events else "Job failed.")
+    return web.Response(body=job.zip_data, content_type="application/zip", headers={"Content-Disposition": f'attachment; filename="{job.filename}"'})
+
+def create_app(credentials):
+    app = web.Application()
+    engine = GenerationEngine(credentials, MetricsStore())
+    app["engine"] = engine
+    app["jobs"] = {}
+    # Strong references so running jobs are not garbage collected mid-flight
+    app["tasks"] = set()
+    app.on_startup.append(engine.start)
+    app.on_cleanup.append(engine.close)
+    app.router.add_post("/jobs", handle_create_job)
+    app.router.add_get("/jobs/{job_id}", handle_job_status)
+    app.router.add_post("/jobs/{job_id}/refine", handle_refine_job)
+    app.router.add_get("/jobs/{job_id}/events", handle_job_events)
+    app.router.add_get("/jobs/{job_id}/zip", handle_job_zip)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the Magic Buttons pipelines over HTTP.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+
+    credentials = load_credential_pool()
+    if not credentials and os.environ.get("OPENAI_API_KEY"):
+        credentials = CredentialPool([Credential(os.environ["OPENAI_API_KEY"])])
+    if not credentials:
+        sys.exit(f"Set OPENAI_API_KEY or create {API_KEY_FILE} before starting the server.")
+    web.run_app(create_app(credentials), host=args.host, port=args.port)
@@ -3,29 +3,163 @@ import json
 import requests
 import zipfile
 import os
+import re
+import threading
+import sqlite3
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from PIL import Image
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QTextEdit, QMessageBox, QProgressBar, QInputDialog
-from PyQt5.QtCore import QThread, pyqtSignal
+from PIL import Image, ImageDraw
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QTextEdit, QMessageBox, QProgressBar, QInputDialog, QCheckBox, QDialog, QDialogButtonBox, QListWidget, QAbstractItemView, QTreeWidget, QTreeWidgetItem, QListView, QListWidgetItem
+from PyQt5.QtCore import QThread, QTimer, QObject, QRunnable, QThreadPool, QSize, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap, QIcon
+from MagicButtonsCommon import API_KEY_FILE, Credential, CredentialPool, GenerationError, MetricsStore, call_cost, load_credential_pool
 
 # OpenAI and DALL-E setup
 CHAT_API_URL = "https://api.openai.com/v1/chat/completions"
 DALLE_API_URL = "https://api.openai.com/v1/images/generations"
-API_KEY_FILE = "api_key.json"
 
-HEADERS = {
-    "Authorization": "",
-    "Content-Type": "application/json"
+# Draft mode renders every image at the cheapest quality and smallest DALL-E 3 size,
+# then only the images the user picks are regenerated at full quality and size.
+DRAFT_IMAGE_SIZE = "1024x1024"
+DRAFT_IMAGE_QUALITY = "standard"
+FINAL_IMAGE_QUALITY = "hd"
+
+CONCEPT_PROMPT = "Create a detailed comic book concept based on the following prompt: {user_prompt}."
+
+# Speculative prefetch starts the concept stage once the prompt has been idle for the debounce
+# interval, and stops for the session once its estimated spend passes the cap so abandoned drafts cannot run up the bill
+PREFETCH_DEBOUNCE_MS = 1500
+PREFETCH_SPEND_CAP = 0.50  # USD
+# Usage assumed for a prefetch still in flight, whose real cost is only known once it returns
+PREFETCH_ESTIMATED_USAGE = {"prompt_tokens": 100, "completion_tokens": 1000}
+
+# Per-stage failure policy: (retries, then "skip" the stage or "abort" the run without producing a bundle).
+# Stages that consume a failed stage's output are skipped rather than fed an error.
+STAGE_POLICIES = {
+    "comic_concept": (2, "abort"),
+    "character_designs": (0, "skip"),
+    "comic_panels": (0, "skip"),
+    "cover_page": (0, "skip"),
+    "pages": (0, "skip"),
 }
+DEFAULT_STAGE_POLICY = (1, "skip")
+STAGE_RETRY_DELAY = 2  # seconds, multiplied by the attempt number
+
+# The window applies queued progress, stage and preview updates at most once per frame
+PROGRESS_FRAME_MS = 33
+PREVIEW_SIZE = 128
+
+# Page compositor layout, in pixels (US comic trim at 150 dpi)
+PAGE_LAYOUT = {
+    "page_size": (994, 1538),
+    "rows": 2,
+    "columns": 2,
+    "margin": 48,
+    "gutter": 24,
+    "border": 4,
+    "background": "white",
+    "border_color": "black",
+}
+PAGE_EXPORT_FORMATS = ["pdf", "cbz"]
+COMPOSITOR_WORKERS = None  # None uses one process per CPU
+# Each image group is generated from the same four prompts (character, two scenes, cover), so only
+# the scene shots are laid out as panels and the cover prompt's image is preferred for the cover
+PANEL_IMAGES = ["image_2.png", "image_3.png"]
+COVER_IMAGE = "image_4.png"
+
+def render_comic_page(panel_images, layout):
+    # Runs in a worker process, so it only takes and returns plain bytes and dicts
+    page_width, page_height = layout["page_size"]
+    rows, columns = layout["rows"], layout["columns"]
+    margin, gutter, border = layout["margin"], layout["gutter"], layout["border"]
+    cell_width = (page_width - 2 * margin - (columns - 1) * gutter) // columns
+    cell_height = (page_height - 2 * margin - (rows - 1) * gutter) // rows
+    inner_width, inner_height = cell_width - 2 * border, cell_height - 2 * border
+
+    page = Image.new("RGB", (page_width, page_height), layout["background"])
+    draw = ImageDraw.Draw(page)
+    for index, panel_data in enumerate(panel_images[:rows * columns]):
+        row, column = divmod(index, columns)
+        x = margin + column * (cell_width + gutter)
+        y = margin + row * (cell_height + gutter)
+        if border:
+            draw.rectangle([x, y, x + cell_width - 1, y + cell_height - 1], fill=layout["border_color"])
+
+        with Image.open(BytesIO(panel_data)) as panel:
+            # Crop to the cell's aspect ratio and scale in a single resize, without an intermediate copy
+            scale = max(inner_width / panel.width, inner_height / panel.height)
+            crop_width, crop_height = inner_width / scale, inner_height / scale
+            left, top = (panel.width - crop_width) / 2, (panel.height - crop_height) / 2
+            fitted = panel.resize((inner_width, inner_height), Image.LANCZOS, box=(left, top, left + crop_width, top + crop_height), reducing_gap=2.0)
+        page.paste(fitted, (x + border, y + border))
+
+    page_buffer = BytesIO()
+    page.save(page_buffer, "PNG")
+    return page_buffer.getvalue()
+
+class PagePool:
+    # One spawn pool per app: each worker re-imports this module, so workers are kept warm between runs
+    def __init__(self, workers=COMPOSITOR_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    def reset(self, executor):
+        # A dead worker breaks the whole pool, so the next composition starts a fresh one
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+class StageAborted(Exception):
+    def __init__(self, stage, reason):
+        super().__init__(f"{stage.replace('_', ' ')} failed: {reason}")
+        self.stage = stage
+
 
 class QuickActionThread(QThread):
     progress = pyqtSignal(int, str)
-    finished = pyqtSignal(bytes, str)
+    stage_status = pyqtSignal(str, str, str)
+    preview = pyqtSignal(str, bytes)
+    # Problems that are not tied to a stage, such as one image failing to download; these go to the log
+    warning = pyqtSignal(str)
+    finished = pyqtSignal(str)
 
-    def __init__(self, action, prompt, parent=None):
+    def __init__(self, action, prompt, draft=False, metrics=None, prefetch=None, credentials=None, page_pool=None, parent=None):
         super().__init__(parent)
         self.action = action
+        self.button = action
         self.prompt = prompt
+        self.draft = draft
+        self.metrics = metrics
+        self.credentials = credentials
+        self.prefetch = prefetch
+        self.page_pool = page_pool
+        self.run_id = uuid.uuid4().hex
+        self.stage = "content"
+        self.attempt = 0
+        self.spend = 0.0
+        self.failures = {}
+        self.bundle = None
+        self.zip_data = None
+        # (bundle group, file name) -> (prompt, full size), used to refine draft images later
+        self.image_requests = {}
 
     def run(self):
         try:
@@ -35,14 +169,16 @@ class QuickActionThread(QThread):
                 result = self.generate_content(self.prompt)
 
             if isinstance(result, dict):
-                zip_data = self.create_zip(result)
-                self.finished.emit(zip_data, f"{self.action}.zip")
+                self.bundle = result
+                self.zip_data = self.create_zip(result)
+                self.finished.emit(f"{self.action}_partial.zip" if self.failures else f"{self.action}.zip")
             else:
-                self.finished.emit(None, result)
+                self.finished.emit(result)
         except Exception as e:
-            self.finished.emit(None, f"Error: {str(e)}")
+            self.finished.emit(f"Error: {str(e)}")
 
-    def generate_content(self, prompt):
+    def generate_content(self, prompt, stage=None):
+        stage = stage or self.stage
         data = {
             "model": "gpt-4",
             "messages": [
@@ -51,53 +187,72 @@ class QuickActionThread(QThread):
             ]
         }
 
+        started = time.perf_counter()
+        credential = self.credentials.acquire()
+        response = None
         try:
-            response = requests.post(CHAT_API_URL, headers=HEADERS, json=data)
+            response = requests.post(CHAT_API_URL, headers=credential.headers, json=data)
             response.raise_for_status()
             response_data = response.json()
             if "choices" not in response_data:
                 error_message = response_data.get("error", {}).get("message", "Unknown error")
-                return f"Error: {error_message}"
+                self.record_call(stage, data["model"], started, error=error_message)
+                raise GenerationError(error_message)
 
             content_text = response_data["choices"][0]["message"]["content"]
+            self.record_call(stage, data["model"], started, usage=response_data.get("usage"))
             return content_text
 
         except requests.RequestException as e:
-            return f"Error: Unable to communicate with the OpenAI API."
+            self.record_call(stage, data["model"], started, error=str(e))
+            raise GenerationError(f"Unable to communicate with the OpenAI API: {e}")
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            # A reply without the expected fields fails the call like any other API error, so run_stage applies the stage policy
+            self.record_call(stage, data["model"], started, error=f"Malformed response: {e!r}")
+            raise GenerationError(f"Malformed response from the OpenAI API: {e!r}")
+        finally:
+            self.release_credential(credential, response)
 
     def generate_comic_book(self):
         comic_book = {}
         user_prompt = self.prompt
         try:
             self.progress.emit(10, "Generating comic book concept...")
-            comic_concept = self.generate_content(f"Create a detailed comic book concept based on the following prompt: {user_prompt}.")
-            comic_book['comic_concept'] = comic_concept
+            comic_concept = self.run_stage(comic_book, "comic_concept", self.generate_concept, user_prompt)
 
             self.progress.emit(20, "Generating detailed plot...")
-            comic_book['plot'] = self.generate_content(f"Create a detailed plot for the comic book: {comic_concept}")
+            self.run_stage(comic_book, "plot", self.generate_content, f"Create a detailed plot for the comic book: {comic_concept}")
 
             self.progress.emit(30, "Generating character designs...")
-            comic_book['character_designs'] = self.generate_images(f"Create character designs for the comic book: {comic_concept}")
+            self.run_stage(comic_book, "character_designs", self.generate_images, f"Create character designs for the comic book: {comic_concept}", 'character_designs')
 
             self.progress.emit(40, "Generating comic panels...")
-            comic_book['comic_panels'] = self.generate_images(f"Create comic panels for the story based on the plot: {comic_concept}")
+            self.run_stage(comic_book, "comic_panels", self.generate_images, f"Create comic panels for the story based on the plot: {comic_concept}", 'comic_panels')
 
             self.progress.emit(50, "Generating cover page...")
-            comic_book['cover_page'] = self.generate_images(f"Create a cover page for the comic book: {comic_concept}")
-
-            self.progress.emit(60, "Generating recap...")
-            comic_book['recap'] = self.generate_content(f"Recap the comic book content: {comic_concept}")
+            self.run_stage(comic_book, "cover_page", self.generate_images, f"Create a cover page for the comic book: {comic_concept}", 'cover_page')
 
-            self.progress.emit(70, "Generating master document...")
-            comic_book['master_document'] = self.create_master_document(comic_book)
+            self.progress.emit(55, "Composing pages...")
+            self.run_stage(comic_book, "pages", self.compose_pages, comic_book, requires=("comic_panels",))
 
-            self.progress.emit(80, "Packaging into ZIP...")
-            return comic_book
+            self.progress.emit(60, "Generating recap...")
+            self.run_stage(comic_book, "recap", self.generate_content, f"Recap the comic book content: {comic_concept}")
 
+        except StageAborted as e:
+            return f"Comic book generation stopped: {str(e)}"
         except Exception as e:
             return f"Error during comic book generation: {str(e)}"
 
-    def generate_images(self, description):
+        if self.failures:
+            comic_book['failures'] = self.failure_report()
+
+        self.progress.emit(70, "Generating master document...")
+        comic_book['master_document'] = self.create_master_document(comic_book)
+
+        self.progress.emit(80, "Packaging into ZIP...")
+        return comic_book
+
+    def generate_images(self, description, group):
         images = {}
         prompts = [
             f"Full-body character design for the comic book, based on the following description: {description}",
@@ -107,41 +262,128 @@ class QuickActionThread(QThread):
         ]
         for i, prompt in enumerate(prompts, start=1):
             self.progress.emit(30 + i * 10, f"Generating image {i}...")
-            image_url = self.generate_image(prompt)
+            self.image_requests[(group, f"image_{i}.png")] = (prompt, "1024x1024")
+            if self.draft:
+                image_url = self.generate_image(prompt, DRAFT_IMAGE_SIZE, DRAFT_IMAGE_QUALITY, stage=group)
+            else:
+                image_url = self.generate_image(prompt, stage=group)
             if image_url:
                 try:
                     image_data = self.download_image(image_url)
                     if image_data:
                         images[f"image_{i}.png"] = image_data
+                        self.preview.emit(f"{group}/image_{i}.png", image_data)
                     else:
                         images[f"image_{i}.png"] = b""
                 except Exception as e:
                     images[f"image_{i}.png"] = b""
-                    self.progress.emit(30 + i * 10, f"Error downloading image {i}: {str(e)}")
+                    self.warning.emit(f"Error downloading image {i}: {str(e)}")
             else:
                 images[f"image_{i}.png"] = b""
+        if not any(images.values()):
+            raise GenerationError(f"No images could be generated for the {group.replace('_', ' ')}.")
         return images
 
-    def generate_image(self, prompt, size="1024x1024"):
+    def generate_image(self, prompt, size="1024x1024", quality=FINAL_IMAGE_QUALITY, stage="image"):
         data = {
             "model": "dall-e-3",
             "prompt": prompt,
             "n": 1,
             "size": size,
-            "quality": "hd",
+            "quality": quality,
             "style": "vivid",
             "response_format": "url"
         }
+        started = time.perf_counter()
+        credential = self.credentials.acquire()
+        response = None
         try:
-            response = requests.post(DALLE_API_URL, headers=HEADERS, json=data)
+            response = requests.post(DALLE_API_URL, headers=credential.headers, json=data)
             response.raise_for_status()
             response_data = response.json()
             image_url = response_data['data'][0]['url']
+            self.record_call(stage, data["model"], started, image_size=size, image_quality=quality)
             return image_url
         except requests.RequestException as e:
             print(f"RequestException generating image: {e}")
+            self.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=str(e))
+            return None
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            self.warning.emit(f"Malformed image response from the OpenAI API: {e!r}")
+            self.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=f"Malformed response: {e!r}")
+            return None
+        finally:
+            self.release_credential(credential, response)
+
+    def release_credential(self, credential, response):
+        if response is None:
+            self.credentials.release(credential)
+            return
+        error_code = None
+        if response.status_code == 429:
+            try:
+                error_code = response.json().get("error", {}).get("code")
+            except ValueError:
+                pass
+        self.credentials.release(credential, response.status_code, response.headers, error_code)
+
+    def run_stage(self, bundle, stage, generate, *args, requires=()):
+        # Stages never run on the output of a failed stage; see STAGE_POLICIES for retry/skip/abort
+        failed_inputs = [name for name in requires if name in self.failures]
+        if failed_inputs:
+            self.failures[stage] = f"Skipped because {', '.join(failed_inputs)} failed."
+            self.stage_status.emit(stage, "Skipped", self.failures[stage])
             return None
 
+        retries, on_failure = STAGE_POLICIES.get(stage, DEFAULT_STAGE_POLICY)
+        self.stage = stage
+        self.stage_status.emit(stage, "Running", "")
+        for self.attempt in range(retries + 1):
+            try:
+                bundle[stage] = generate(*args)
+                self.stage_status.emit(stage, "Done", "")
+                return bundle[stage]
+            except GenerationError as e:
+                error = e
+                if self.attempt < retries:
+                    self.stage_status.emit(stage, "Retrying", f"Attempt {self.attempt + 1} failed: {str(e)}")
+                    time.sleep(STAGE_RETRY_DELAY * (self.attempt + 1))
+
+        self.failures[stage] = str(error)
+        self.stage_status.emit(stage, "Failed", str(error))
+        if on_failure == "abort":
+            raise StageAborted(stage, str(error))
+        return None
+
+    def generate_concept(self, user_prompt):
+        concept = self.prefetched_concept()
+        if concept is None:
+            concept = self.generate_content(CONCEPT_PROMPT.format(user_prompt=user_prompt))
+        return concept
+
+    def prefetched_concept(self):
+        # Reuse the speculative concept request started while the user was typing this same prompt
+        if not self.prefetch or self.prefetch.prompt != self.prompt:
+            return None
+        started = time.perf_counter()
+        self.prefetch.wait()
+        if self.prefetch.concept is None:
+            return None
+        self.record_call(self.stage, "gpt-4", started, cache_hit=True)
+        return self.prefetch.concept
+
+    def failure_report(self):
+        return "\n".join(f"{stage.replace('_', ' ').capitalize()}: {reason}" for stage, reason in self.failures.items())
+
+    def record_call(self, stage, model, started, usage=None, image_size=None, image_quality=None, cache_hit=False, error=None):
+        self.spend += call_cost(model, usage, image_size, image_quality, cache_hit, error)
+        if self.metrics:
+            latency_ms = (time.perf_counter() - started) * 1000
+            try:
+                self.metrics.record(self.run_id, self.button, stage, model, latency_ms, usage, image_size, image_quality, self.attempt, cache_hit, error)
+            except sqlite3.Error as e:
+                self.warning.emit(f"Could not record metrics: {str(e)}")
+
     def download_image(self, image_url):
         try:
             response = requests.get(image_url)
@@ -151,6 +393,68 @@ class QuickActionThread(QThread):
             print(f"RequestException downloading image: {e}")
             return None
 
+    def compose_pages(self, comic_book):
+        cover_layout = dict(PAGE_LAYOUT, rows=1, columns=1, margin=0, gutter=0, border=0)
+        panels_per_page = PAGE_LAYOUT["rows"] * PAGE_LAYOUT["columns"]
+        cover_images = sorted(comic_book.get('cover_page', {}).items(), key=lambda item: item[0] != COVER_IMAGE)
+        cover = [data for name, data in cover_images if data][:1]
+        panel_images = comic_book.get('comic_panels', {})
+        panels = [panel_images[name] for name in PANEL_IMAGES if panel_images.get(name)]
+
+        page_jobs = {}
+        if cover:
+            page_jobs["page_00_cover.png"] = (cover, cover_layout)
+        for start in range(0, len(panels), panels_per_page):
+            page_jobs[f"page_{len(page_jobs) + 1 - len(cover):02d}.png"] = (panels[start:start + panels_per_page], PAGE_LAYOUT)
+        if not page_jobs:
+            raise GenerationError("No panels to compose.")
+
+        # Keys are seeded in reading order so pages stream in as they finish but stay ordered
+        pages = dict.fromkeys(page_jobs)
+        executor = self.page_pool.get()
+        try:
+            futures = {executor.submit(render_comic_page, images, layout): name for name, (images, layout) in page_jobs.items()}
+            for done, future in enumerate(as_completed(futures), start=1):
+                name = futures[future]
+                try:
+                    pages[name] = future.result()
+                    self.preview.emit(f"pages/{name}", pages[name])
+                    self.progress.emit(55, f"Composed {name} ({done}/{len(futures)})")
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    del pages[name]
+                    self.warning.emit(f"Error composing {name}: {str(e)}")
+        except (OSError, BrokenProcessPool) as e:
+            self.page_pool.reset(executor)
+            raise GenerationError(f"Page compositor failed: {str(e)}")
+        if not pages:
+            raise GenerationError("No pages could be composed.")
+
+        # The exports sit next to the pages they were built from, under pages/ in the bundle
+        composed = dict(pages)
+        if "pdf" in PAGE_EXPORT_FORMATS:
+            composed['comic.pdf'] = self.export_pdf(pages)
+        if "cbz" in PAGE_EXPORT_FORMATS:
+            composed['comic.cbz'] = self.export_cbz(pages)
+        return composed
+
+    def export_pdf(self, pages):
+        page_images = [Image.open(BytesIO(data)) for data in pages.values()]
+        pdf_buffer = BytesIO()
+        page_images[0].save(pdf_buffer, "PDF", save_all=True, append_images=page_images[1:], resolution=150)
+        for page_image in page_images:
+            page_image.close()
+        return pdf_buffer.getvalue()
+
+    def export_cbz(self, pages):
+        # Pages are already compressed PNGs, so they are stored rather than deflated again
+        cbz_buffer = BytesIO()
+        with zipfile.ZipFile(cbz_buffer, 'w', zipfile.ZIP_STORED) as cbz_file:
+            for name, data in pages.items():
+                cbz_file.writestr(name, data)
+        return cbz_buffer.getvalue()
+
     def create_master_document(self, comic_book):
         master_doc = "Comic Book Master Document\n\n"
         for key, value in comic_book.items():
@@ -181,23 +485,89 @@ class QuickActionThread(QThread):
         self.progress.emit(100, "ZIP package created.")
         return zip_buffer.read()
 
+class RefineImagesThread(QuickActionThread):
+    def __init__(self, action, bundle, image_requests, selected, metrics=None, credentials=None, page_pool=None, parent=None):
+        super().__init__(action, "", metrics=metrics, credentials=credentials, page_pool=page_pool, parent=parent)
+        self.bundle = bundle
+        self.image_requests = image_requests
+        self.selected = selected
+
+    def run(self):
+        try:
+            for i, (group, name) in enumerate(self.selected):
+                self.progress.emit(i * 90 // len(self.selected), f"Refining {group}/{name} in HD...")
+                prompt, size = self.image_requests[(group, name)]
+                image_url = self.generate_image(prompt, size, FINAL_IMAGE_QUALITY, stage=f"refine_{group}")
+                image_data = self.download_image(image_url) if image_url else None
+                if image_data:
+                    self.bundle[group][name] = image_data
+                    self.preview.emit(f"{group}/{name}", image_data)
+                    del self.image_requests[(group, name)]
+                else:
+                    self.warning.emit(f"Could not refine {group}/{name}, keeping the draft.")
+
+            if 'pages' in self.bundle:
+                self.progress.emit(90, "Recomposing pages...")
+                try:
+                    self.bundle['pages'] = self.compose_pages(self.bundle)
+                except GenerationError as e:
+                    self.warning.emit(f"Could not recompose pages, keeping the draft pages: {str(e)}")
+
+            self.zip_data = self.create_zip(self.bundle)
+            self.finished.emit(f"{self.action}.zip")
+        except Exception as e:
+            self.finished.emit(f"Error: {str(e)}")
+
+class ConceptPrefetchThread(QuickActionThread):
+    def __init__(self, action, prompt, metrics=None, credentials=None, parent=None):
+        super().__init__(action, prompt, metrics=metrics, credentials=credentials, parent=parent)
+        # Speculative spend is reported apart from the bundles it ends up feeding
+        self.button = f"{action} (prefetch)"
+        self.concept = None
+
+    def run(self):
+        try:
+            self.concept = self.generate_content(CONCEPT_PROMPT.format(user_prompt=self.prompt), stage="comic_concept")
+        except GenerationError:
+            self.concept = None
+
+class PreviewSignals(QObject):
+    decoded = pyqtSignal(str, QImage)
+
+class PreviewDecoder(QRunnable):
+    # Decodes and downscales an image on the thread pool; QImage, unlike QPixmap, is safe to build off the GUI thread
+    def __init__(self, name, data):
+        super().__init__()
+        self.name = name
+        self.data = data
+        self.signals = PreviewSignals()
+
+    def run(self):
+        try:
+            with Image.open(BytesIO(self.data)) as image:
+                image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+                image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), reducing_gap=2.0)
+                thumbnail = image.convert("RGBA")
+        except Exception:
+            return
+        preview = QImage(thumbnail.tobytes("raw", "RGBA"), thumbnail.width, thumbnail.height, QImage.Format_RGBA8888).copy()
+        self.signals.decoded.emit(self.name, preview)
+
 class QuickActionsApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Quick Actions - Comic Book Creator")
 
-        self.api_key = self.load_api_key()
-        if not self.api_key:
-            self.api_key = self.ask_api_key()
-            if not self.api_key:
+        self.credentials = load_credential_pool()
+        if not self.credentials:
+            api_key = self.ask_api_key()
+            if not api_key:
                 QMessageBox.critical(self, "Error", "API key is required to proceed.")
                 sys.exit()
+            self.credentials = CredentialPool([Credential(api_key)])
 
-        global HEADERS
-        HEADERS = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        self.metrics = MetricsStore()
+        self.page_pool = PagePool()
 
         # Main layout
         self.main_widget = QWidget()
@@ -207,31 +577,78 @@ class QuickActionsApp(QMainWindow):
 
         self.prompt_label = QLabel("Enter topic/keywords:")
         self.prompt_entry = QLineEdit()
+        self.prompt_entry.textChanged.connect(self.handle_prompt_changed)
         self.main_layout.addWidget(self.prompt_label)
         self.main_layout.addWidget(self.prompt_entry)
 
+        self.stage_panel = QTreeWidget()
+        self.stage_panel.setHeaderLabels(["Stage", "Status", "Detail"])
+        self.stage_panel.setRootIsDecorated(False)
+        self.main_layout.addWidget(self.stage_panel)
+        self.stage_items = {}
+
+        self.preview_list = QListWidget()
+        self.preview_list.setViewMode(QListView.IconMode)
+        self.preview_list.setIconSize(QSize(PREVIEW_SIZE, PREVIEW_SIZE))
+        self.preview_list.setResizeMode(QListView.Adjust)
+        self.preview_list.setFixedHeight(PREVIEW_SIZE + 48)
+        self.main_layout.addWidget(self.preview_list)
+        self.preview_items = {}
+
         self.result_box = QTextEdit()
         self.result_box.setReadOnly(True)
         self.main_layout.addWidget(self.result_box)
 
+        self.activity_label = QLabel("")
+        self.main_layout.addWidget(self.activity_label)
+
         self.progress_bar = QProgressBar()
         self.main_layout.addWidget(self.progress_bar)
 
+        # Worker signals only record the latest state; the frame timer applies it to the widgets
+        self.pending_progress = None
+        self.pending_stages = {}
+        self.pending_previews = {}
+        self.pending_warnings = []
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(PROGRESS_FRAME_MS)
+        self.frame_timer.timeout.connect(self.apply_pending_updates)
+
+        self.draft_checkbox = QCheckBox("Draft mode (fast previews, refine selected images later)")
+        self.main_layout.addWidget(self.draft_checkbox)
+        self.draft_thread = None
+
+        self.prefetch_checkbox = QCheckBox("Speculative prefetch (start the concept while you type)")
+        self.prefetch_checkbox.toggled.connect(self.handle_prompt_changed)
+        self.main_layout.addWidget(self.prefetch_checkbox)
+        self.prefetch_thread = None
+        self.prefetch_threads = []
+        self.prefetch_capped = False
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(PREFETCH_DEBOUNCE_MS)
+        self.prefetch_timer.timeout.connect(self.start_prefetch)
+
         self.actions = [
             "comic book"
         ]
 
+        self.action_buttons = []
         for action in self.actions:
             button = QPushButton(f"Generate {action.capitalize()}")
             button.clicked.connect(lambda checked, a=action: self.handle_action(a))
             self.main_layout.addWidget(button)
+            self.action_buttons.append(button)
 
-    def load_api_key(self):
-        if os.path.exists(API_KEY_FILE):
-            with open(API_KEY_FILE, 'r') as file:
-                data = json.load(file)
-                return data.get('api_key')
-        return None
+        self.refine_button = QPushButton("Refine Selected Images to HD")
+        self.refine_button.setEnabled(False)
+        self.refine_button.clicked.connect(self.handle_refine)
+        self.main_layout.addWidget(self.refine_button)
+
+    def closeEvent(self, event):
+        self.page_pool.shutdown()
+        super().closeEvent(event)
 
     def ask_api_key(self):
         api_key, ok = QInputDialog.getText(self, "API Key", "Please enter your OpenAI API key:", QLineEdit.Password)
@@ -241,31 +658,171 @@ class QuickActionsApp(QMainWindow):
             return api_key
         return None
 
+    def handle_prompt_changed(self):
+        self.prefetch_timer.stop()
+        # A request in flight cannot be aborted, so a stale prefetch is simply dropped and its result ignored
+        if self.prefetch_thread and self.prefetch_thread.prompt != self.prompt_entry.text():
+            self.prefetch_thread = None
+        if self.prefetch_checkbox.isChecked():
+            self.prefetch_timer.start()
+
+    def start_prefetch(self):
+        prompt = self.prompt_entry.text()
+        if not prompt.strip() or self.prefetch_thread:
+            return
+        if self.prefetch_spend() >= PREFETCH_SPEND_CAP:
+            if not self.prefetch_capped:
+                self.result_box.append("Speculative prefetch spend cap reached for this session.")
+                self.prefetch_capped = True
+            return
+        # Parented to the window so Qt keeps the thread alive after it is dropped
+        self.prefetch_thread = ConceptPrefetchThread(self.actions[0], prompt, metrics=self.metrics, credentials=self.credentials, parent=self)
+        self.prefetch_threads.append(self.prefetch_thread)
+        self.prefetch_thread.start()
+
+    def prefetch_spend(self):
+        # Stale prefetches still bill even though their results are dropped; those in flight count at an estimate
+        estimate = call_cost("gpt-4", PREFETCH_ESTIMATED_USAGE)
+        return sum(thread.spend if thread.isFinished() else estimate for thread in self.prefetch_threads)
+
     def handle_action(self, action):
         prompt = self.prompt_entry.text()
         self.result_box.append(f"Generating {action}...")
         self.progress_bar.setValue(0)
-        self.quick_action_thread = QuickActionThread(action, prompt)
-        self.quick_action_thread.progress.connect(self.update_progress)
-        self.quick_action_thread.finished.connect(self.handle_finished)
+        self.refine_button.setEnabled(False)
+        self.stage_panel.clear()
+        self.stage_items = {}
+        self.preview_list.clear()
+        self.preview_items = {}
+        self.quick_action_thread = QuickActionThread(action, prompt, draft=self.draft_checkbox.isChecked(), metrics=self.metrics, prefetch=self.prefetch_thread, credentials=self.credentials, page_pool=self.page_pool, parent=self)
+        # A prefetched concept feeds one run only, so generating again with the same prompt asks for a fresh concept
+        self.prefetch_thread = None
+        self.connect_thread(self.quick_action_thread)
+        self.quick_action_thread.start()
+        self.set_busy(True)
+
+    def connect_thread(self, thread):
+        thread.progress.connect(self.update_progress)
+        thread.stage_status.connect(self.update_stage)
+        thread.preview.connect(self.decode_preview)
+        thread.warning.connect(self.queue_warning)
+        # Bound to the thread that emits it, so the result is read from the run that produced it
+        thread.finished.connect(lambda filename_or_error, thread=thread: self.handle_finished(thread, filename_or_error))
+
+    def set_busy(self, busy):
+        # One run at a time: the shared bundle and refine state belong to the thread that is running
+        for button in self.action_buttons:
+            button.setEnabled(not busy)
+
+    def handle_refine(self):
+        if not self.draft_thread or not self.draft_thread.image_requests:
+            self.result_box.append("No draft images left to refine.")
+            return
+        selected = self.select_images(list(self.draft_thread.image_requests))
+        if not selected:
+            return
+        self.result_box.append(f"Refining {len(selected)} image(s) in HD...")
+        self.progress_bar.setValue(0)
+        self.refine_button.setEnabled(False)
+        self.quick_action_thread = RefineImagesThread(self.draft_thread.action, self.draft_thread.bundle, self.draft_thread.image_requests, selected, metrics=self.metrics, credentials=self.credentials, page_pool=self.page_pool, parent=self)
+        self.connect_thread(self.quick_action_thread)
         self.quick_action_thread.start()
+        self.set_busy(True)
+
+    def select_images(self, image_keys):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Refine Images")
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel("Select the draft images to regenerate in HD:"))
+        image_list = QListWidget()
+        image_list.setSelectionMode(QAbstractItemView.MultiSelection)
+        for group, name in image_keys:
+            image_list.addItem(f"{group}/{name}")
+        layout.addWidget(image_list)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout.addWidget(buttons)
+        if dialog.exec_() != QDialog.Accepted:
+            return []
+        return [image_keys[image_list.row(item)] for item in image_list.selectedItems()]
 
     def update_progress(self, value, message):
-        self.progress_bar.setValue(value)
-        self.result_box.append(message)
-
-    def handle_finished(self, zip_data, filename_or_error):
-        if zip_data:
+        self.pending_progress = (value, message)
+        self.schedule_frame()
+
+    def update_stage(self, stage, status, detail):
+        self.pending_stages[stage] = (status, detail)
+        self.schedule_frame()
+
+    def decode_preview(self, name, data):
+        decoder = PreviewDecoder(name, data)
+        decoder.signals.decoded.connect(self.queue_preview)
+        QThreadPool.globalInstance().start(decoder)
+
+    def queue_preview(self, name, image):
+        self.pending_previews[name] = image
+        self.schedule_frame()
+
+    def queue_warning(self, message):
+        self.pending_warnings.append(message)
+        self.schedule_frame()
+
+    def schedule_frame(self):
+        if not self.frame_timer.isActive():
+            self.frame_timer.start()
+
+    def apply_pending_updates(self):
+        if self.pending_progress:
+            value, message = self.pending_progress
+            self.progress_bar.setValue(value)
+            self.activity_label.setText(message)
+        for stage, (status, detail) in self.pending_stages.items():
+            if stage not in self.stage_items:
+                self.stage_items[stage] = QTreeWidgetItem(self.stage_panel, [stage.replace('_', ' ').capitalize(), "", ""])
+            self.stage_items[stage].setText(1, status)
+            self.stage_items[stage].setText(2, detail)
+        for name, image in self.pending_previews.items():
+            if name not in self.preview_items:
+                self.preview_items[name] = QListWidgetItem(name, self.preview_list)
+            self.preview_items[name].setIcon(QIcon(QPixmap.fromImage(image)))
+        if self.pending_warnings:
+            self.result_box.append("\n".join(self.pending_warnings))
+        self.pending_progress = None
+        self.pending_stages = {}
+        self.pending_previews = {}
+        self.pending_warnings = []
+
+    def handle_finished(self, thread, filename_or_error):
+        self.apply_pending_updates()
+        self.set_busy(False)
+        if isinstance(thread, RefineImagesThread) or thread.draft:
+            if self.draft_thread and self.draft_thread is not thread:
+                self.draft_thread.deleteLater()
+            self.draft_thread = thread if thread.bundle else None
+            self.refine_button.setEnabled(bool(self.draft_thread and self.draft_thread.image_requests))
+        if thread.failures:
+            self.result_box.append(thread.failure_report())
+        if thread.zip_data:
             options = QFileDialog.Options()
             file_path, _ = QFileDialog.getSaveFileName(self, "Save ZIP", "", "Zip Files (*.zip);;All Files (*)", options=options)
             if file_path:
                 with open(file_path, 'wb') as file:
-                    file.write(zip_data)
+                    file.write(thread.zip_data)
             self.result_box.append(f"{filename_or_error} generated and saved.")
         else:
             self.result_box.append(filename_or_error)
+        # The window owns its worker threads, so each is released once nothing needs its result;
+        # finished is emitted from the end of run(), so wait for run() to return before deleting
+        if thread is not self.draft_thread:
+            thread.wait()
+            thread.deleteLater()
 
 if __name__ == "__main__":
+    if "--report" in sys.argv:
+        print(MetricsStore().report())
+        sys.exit()
+
     app = QApplication(sys.argv)
     window = QuickActionsApp()
     window.show()
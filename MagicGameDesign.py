@@ -3,30 +3,119 @@ import json
 import requests
 import zipfile
 import os
+import re
+import threading
+import sqlite3
+import time
+import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QTextEdit, QMessageBox, QProgressBar, QInputDialog
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QTextEdit, QMessageBox, QProgressBar, QInputDialog, QCheckBox, QDialog, QDialogButtonBox, QListWidget, QAbstractItemView, QTreeWidget, QTreeWidgetItem, QListView, QListWidgetItem
+from PyQt5.QtCore import QThread, QTimer, QObject, QRunnable, QThreadPool, QSize, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap, QIcon
+from MagicButtonsCommon import API_KEY_FILE, Credential, CredentialPool, GenerationError, MetricsStore, call_cost, load_credential_pool
 
 # OpenAI and DALL-E setup
 
 CHAT_API_URL = "https://api.openai.com/v1/chat/completions"
 DALLE_API_URL = "https://api.openai.com/v1/images/generations"
-API_KEY_FILE = "api_key.json"
 
-HEADERS = {
-    "Authorization": "",
-    "Content-Type": "application/json"
+# Draft mode renders every image at the cheapest quality and smallest DALL-E 3 size,
+# then only the images the user picks are regenerated at full quality and size.
+DRAFT_IMAGE_SIZE = "1024x1024"
+DRAFT_IMAGE_QUALITY = "standard"
+FINAL_IMAGE_QUALITY = "hd"
+
+CONCEPT_PROMPT = "Invent a new 2D game concept with a detailed theme, setting, and unique features based on the following prompt: {user_prompt}. Ensure the game has WASD controls."
+
+# Speculative prefetch starts the concept stage once the prompt has been idle for the debounce
+# interval, and stops for the session once its estimated spend passes the cap so abandoned drafts cannot run up the bill
+PREFETCH_DEBOUNCE_MS = 1500
+PREFETCH_SPEND_CAP = 0.50  # USD
+# Usage assumed for a prefetch still in flight, whose real cost is only known once it returns
+PREFETCH_ESTIMATED_USAGE = {"prompt_tokens": 100, "completion_tokens": 1000}
+
+# Per-stage failure policy: (retries, then "skip" the stage or "abort" the run without producing a bundle).
+# Stages that consume a failed stage's output are skipped rather than fed an error.
+STAGE_POLICIES = {
+    "game_concept": (2, "abort"),
+    "world_concept": (2, "skip"),
+    "character_concepts": (2, "skip"),
+    "images": (0, "skip"),
+    "unity_scripts": (0, "skip"),
 }
+DEFAULT_STAGE_POLICY = (1, "skip")
+STAGE_RETRY_DELAY = 2  # seconds, multiplied by the attempt number
+
+# Unity scripts are requested concurrently, cached on disk per request, and deduplicated by content
+UNITY_SCRIPT_PROMPT = "{description}. Respond with one complete C# MonoBehaviour script in a single ```csharp code block."
+UNITY_SCRIPT_WORKERS = 6
+UNITY_SCRIPT_CACHE_DIR = "unity_script_cache"
+# C# comments and string/char literals, so a class rename only touches the identifiers outside them (group 1)
+CSHARP_TOKEN_PATTERN = re.compile(r'''//[^\n]*|/\*.*?\*/|(?:\$@|@\$?)"(?:[^"]|"")*"|\$?"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|\b(\w+)\b''', re.S)
+
+# The window applies queued progress, stage and preview updates at most once per frame
+PROGRESS_FRAME_MS = 33
+PREVIEW_SIZE = 128
+
+class StageAborted(Exception):
+    def __init__(self, stage, reason):
+        super().__init__(f"{stage.replace('_', ' ')} failed: {reason}")
+        self.stage = stage
+
+
+def extract_code(content):
+    # The first fenced block of the reply, without the surrounding prose; None if the reply has no code block
+    match = re.search(r"```[\w#+-]*[ \t]*\n(.*?)```", content, re.S)
+    return match.group(1).strip() + "\n" if match else None
+
+def name_script(code, index, taken):
+    # Unity needs a MonoBehaviour's file named after its class, so a class that clashes with an
+    # earlier script is renamed in the code as well as the file name
+    identifiers = [match.group(1) for match in CSHARP_TOKEN_PATTERN.finditer(code) if match.group(1)]
+    class_name = next((name for keyword, name in zip(identifiers, identifiers[1:]) if keyword == "class"), None)
+    if not class_name:
+        return f"script_{index}.cs", code
+    name = class_name
+    while f"{name}.cs" in taken:
+        name = f"{name}{index}"
+    if name != class_name:
+        # Only identifiers are renamed: the declaration, constructors and type uses, never comments or string text
+        code = CSHARP_TOKEN_PATTERN.sub(lambda match: name if match.group(1) == class_name else match.group(0), code)
+    return f"{name}.cs", code
+
+def script_digest(code):
+    # Whitespace-insensitive so the same script with different trailing spaces or line endings dedupes
+    return hashlib.sha256("\n".join(line.rstrip() for line in code.strip().splitlines()).encode("utf-8")).hexdigest()
 
 class QuickActionThread(QThread):
     progress = pyqtSignal(int, str)
-    finished = pyqtSignal(bytes, str)
+    stage_status = pyqtSignal(str, str, str)
+    preview = pyqtSignal(str, bytes)
+    # Problems that are not tied to a stage, such as one image failing to download; these go to the log
+    warning = pyqtSignal(str)
+    finished = pyqtSignal(str)
 
-    def __init__(self, action, prompt, parent=None):
+    def __init__(self, action, prompt, draft=False, metrics=None, prefetch=None, credentials=None, parent=None):
         super().__init__(parent)
         self.action = action
+        self.button = action
         self.prompt = prompt
+        self.draft = draft
+        self.metrics = metrics
+        self.credentials = credentials
+        self.prefetch = prefetch
+        self.run_id = uuid.uuid4().hex
+        self.stage = "content"
+        self.attempt = 0
+        self.spend = 0.0
+        self.failures = {}
+        self.bundle = None
+        self.zip_data = None
+        # (bundle group, file name) -> (prompt, full size), used to refine draft images later
+        self.image_requests = {}
 
     def run(self):
         try:
@@ -36,14 +125,16 @@ class QuickActionThread(QThread):
                 result = self.generate_content(self.prompt)
 
             if isinstance(result, dict):
-                zip_data = self.create_zip(result)
-                self.finished.emit(zip_data, f"{self.action}.zip")
+                self.bundle = result
+                self.zip_data = self.create_zip(result)
+                self.finished.emit(f"{self.action}_partial.zip" if self.failures else f"{self.action}.zip")
             else:
-                self.finished.emit(None, result)
+                self.finished.emit(result)
         except Exception as e:
-            self.finished.emit(None, f"Error: {str(e)}")
+            self.finished.emit(f"Error: {str(e)}")
 
-    def generate_content(self, prompt):
+    def generate_content(self, prompt, stage=None):
+        stage = stage or self.stage
         data = {
             "model": "gpt-4",
             "messages": [
@@ -52,58 +143,74 @@ class QuickActionThread(QThread):
             ]
         }
 
+        started = time.perf_counter()
+        credential = self.credentials.acquire()
+        response = None
         try:
-            response = requests.post(CHAT_API_URL, headers=HEADERS, json=data)
+            response = requests.post(CHAT_API_URL, headers=credential.headers, json=data)
             response.raise_for_status()
             response_data = response.json()
             if "choices" not in response_data:
                 error_message = response_data.get("error", {}).get("message", "Unknown error")
-                return f"Error: {error_message}"
+                self.record_call(stage, data["model"], started, error=error_message)
+                raise GenerationError(error_message)
 
             content_text = response_data["choices"][0]["message"]["content"]
+            self.record_call(stage, data["model"], started, usage=response_data.get("usage"))
             return content_text
 
         except requests.RequestException as e:
-            return f"Error: Unable to communicate with the OpenAI API."
+            self.record_call(stage, data["model"], started, error=str(e))
+            raise GenerationError(f"Unable to communicate with the OpenAI API: {e}")
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            # A reply without the expected fields fails the call like any other API error, so run_stage applies the stage policy
+            self.record_call(stage, data["model"], started, error=f"Malformed response: {e!r}")
+            raise GenerationError(f"Malformed response from the OpenAI API: {e!r}")
+        finally:
+            self.release_credential(credential, response)
 
     def generate_game_plan(self):
         game_plan = {}
         user_prompt = self.prompt
         try:
             self.progress.emit(10, "Generating game concept...")
-            game_concept = self.generate_content(f"Invent a new 2D game concept with a detailed theme, setting, and unique features based on the following prompt: {user_prompt}. Ensure the game has WASD controls.")
-            game_plan['game_concept'] = game_concept
+            game_concept = self.run_stage(game_plan, "game_concept", self.generate_concept, user_prompt)
 
             self.progress.emit(20, "Generating world concept...")
-            game_plan['world_concept'] = self.generate_content(f"Create a detailed world concept for the 2D game: {game_concept}")
+            world_concept = self.run_stage(game_plan, "world_concept", self.generate_content, f"Create a detailed world concept for the 2D game: {game_concept}")
 
             self.progress.emit(30, "Generating character concepts...")
-            game_plan['character_concepts'] = self.generate_content(f"Create detailed character concepts for the player and enemies in the 2D game: {game_concept}")
+            character_concepts = self.run_stage(game_plan, "character_concepts", self.generate_content, f"Create detailed character concepts for the player and enemies in the 2D game: {game_concept}")
 
             self.progress.emit(40, "Generating plot...")
-            game_plan['plot'] = self.generate_content(f"Create a plot for the 2D game based on the world and characters of the game: {game_concept}")
+            self.run_stage(game_plan, "plot", self.generate_content, f"Create a plot for the 2D game based on the world and characters of the game: {game_concept}")
 
             self.progress.emit(50, "Generating dialogue...")
-            game_plan['dialogue'] = self.generate_content(f"Write some dialogue for the 2D game based on the plot of the game: {game_concept}")
+            self.run_stage(game_plan, "dialogue", self.generate_content, f"Write some dialogue for the 2D game based on the plot of the game: {game_concept}")
 
             self.progress.emit(60, "Generating images...")
-            game_plan['images'] = self.generate_images(game_concept, game_plan['character_concepts'], game_plan['world_concept'])
+            self.run_stage(game_plan, "images", self.generate_images, game_concept, character_concepts, world_concept, requires=("character_concepts", "world_concept"))
 
             self.progress.emit(70, "Generating Unity scripts...")
-            game_plan['unity_scripts'] = self.generate_unity_scripts(game_concept, game_plan['character_concepts'], game_plan['world_concept'])
+            self.run_stage(game_plan, "unity_scripts", self.generate_unity_scripts, game_concept, character_concepts, world_concept, requires=("character_concepts", "world_concept"))
 
             self.progress.emit(80, "Generating recap...")
-            game_plan['recap'] = self.generate_content(f"Recap the game plan for the 2D game: {game_concept}")
-
-            self.progress.emit(85, "Generating master document...")
-            game_plan['master_document'] = self.create_master_document(game_plan)
-
-            self.progress.emit(90, "Packaging into ZIP...")
-            return game_plan
+            self.run_stage(game_plan, "recap", self.generate_content, f"Recap the game plan for the 2D game: {game_concept}")
 
+        except StageAborted as e:
+            return f"Game plan generation stopped: {str(e)}"
         except Exception as e:
             return f"Error during game plan generation: {str(e)}"
 
+        if self.failures:
+            game_plan['failures'] = self.failure_report()
+
+        self.progress.emit(85, "Generating master document...")
+        game_plan['master_document'] = self.create_master_document(game_plan)
+
+        self.progress.emit(90, "Packaging into ZIP...")
+        return game_plan
+
     def generate_images(self, game_concept, character_concepts, world_concept):
         images = {}
         descriptions = [
@@ -116,22 +223,136 @@ class QuickActionThread(QThread):
         ]
         for i, desc in enumerate(descriptions, start=1):
             self.progress.emit(60 + i * 5, f"Generating image {i}...")
-            image_content = self.generate_image(desc)
-            if image_content:
-                images[f"image_{i}.png"] = image_content
+            self.image_requests[("images", f"image_{i}.png")] = (desc, "1024x1024")
+            if self.draft:
+                image_url = self.generate_image(desc, DRAFT_IMAGE_SIZE, DRAFT_IMAGE_QUALITY, stage="images")
+            else:
+                image_url = self.generate_image(desc, stage="images")
+            if image_url:
+                try:
+                    image_data = self.download_image(image_url)
+                    if image_data:
+                        images[f"image_{i}.png"] = image_data
+                        self.preview.emit(f"images/image_{i}.png", image_data)
+                    else:
+                        images[f"image_{i}.png"] = b""
+                except Exception as e:
+                    images[f"image_{i}.png"] = b""
+                    self.warning.emit(f"Error downloading image {i}: {str(e)}")
             else:
                 images[f"image_{i}.png"] = b""
+        if not any(images.values()):
+            raise GenerationError("No images could be generated.")
         return images
 
-    def generate_image(prompt, size="1024x1024"):
-        response = openai.Image.create(
-            prompt=prompt,
-            n=1,
-            size=size,
-            response_format="url"
-        )
-        image_url = response['data'][0]['url']
-        return image_url
+    def generate_image(self, prompt, size="1024x1024", quality=FINAL_IMAGE_QUALITY, stage="image"):
+        data = {
+            "model": "dall-e-3",
+            "prompt": prompt,
+            "n": 1,
+            "size": size,
+            "quality": quality,
+            "style": "vivid",
+            "response_format": "url"
+        }
+        started = time.perf_counter()
+        credential = self.credentials.acquire()
+        response = None
+        try:
+            response = requests.post(DALLE_API_URL, headers=credential.headers, json=data)
+            response.raise_for_status()
+            response_data = response.json()
+            image_url = response_data['data'][0]['url']
+            self.record_call(stage, data["model"], started, image_size=size, image_quality=quality)
+            return image_url
+        except requests.RequestException as e:
+            print(f"RequestException generating image: {e}")
+            self.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=str(e))
+            return None
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            self.warning.emit(f"Malformed image response from the OpenAI API: {e!r}")
+            self.record_call(stage, data["model"], started, image_size=size, image_quality=quality, error=f"Malformed response: {e!r}")
+            return None
+        finally:
+            self.release_credential(credential, response)
+
+    def release_credential(self, credential, response):
+        if response is None:
+            self.credentials.release(credential)
+            return
+        error_code = None
+        if response.status_code == 429:
+            try:
+                error_code = response.json().get("error", {}).get("code")
+            except ValueError:
+                pass
+        self.credentials.release(credential, response.status_code, response.headers, error_code)
+
+    def run_stage(self, bundle, stage, generate, *args, requires=()):
+        # Stages never run on the output of a failed stage; see STAGE_POLICIES for retry/skip/abort
+        failed_inputs = [name for name in requires if name in self.failures]
+        if failed_inputs:
+            self.failures[stage] = f"Skipped because {', '.join(failed_inputs)} failed."
+            self.stage_status.emit(stage, "Skipped", self.failures[stage])
+            return None
+
+        retries, on_failure = STAGE_POLICIES.get(stage, DEFAULT_STAGE_POLICY)
+        self.stage = stage
+        self.stage_status.emit(stage, "Running", "")
+        for self.attempt in range(retries + 1):
+            try:
+                bundle[stage] = generate(*args)
+                self.stage_status.emit(stage, "Done", "")
+                return bundle[stage]
+            except GenerationError as e:
+                error = e
+                if self.attempt < retries:
+                    self.stage_status.emit(stage, "Retrying", f"Attempt {self.attempt + 1} failed: {str(e)}")
+                    time.sleep(STAGE_RETRY_DELAY * (self.attempt + 1))
+
+        self.failures[stage] = str(error)
+        self.stage_status.emit(stage, "Failed", str(error))
+        if on_failure == "abort":
+            raise StageAborted(stage, str(error))
+        return None
+
+    def generate_concept(self, user_prompt):
+        concept = self.prefetched_concept()
+        if concept is None:
+            concept = self.generate_content(CONCEPT_PROMPT.format(user_prompt=user_prompt))
+        return concept
+
+    def prefetched_concept(self):
+        # Reuse the speculative concept request started while the user was typing this same prompt
+        if not self.prefetch or self.prefetch.prompt != self.prompt:
+            return None
+        started = time.perf_counter()
+        self.prefetch.wait()
+        if self.prefetch.concept is None:
+            return None
+        self.record_call(self.stage, "gpt-4", started, cache_hit=True)
+        return self.prefetch.concept
+
+    def failure_report(self):
+        return "\n".join(f"{stage.replace('_', ' ').capitalize()}: {reason}" for stage, reason in self.failures.items())
+
+    def record_call(self, stage, model, started, usage=None, image_size=None, image_quality=None, cache_hit=False, error=None):
+        self.spend += call_cost(model, usage, image_size, image_quality, cache_hit, error)
+        if self.metrics:
+            latency_ms = (time.perf_counter() - started) * 1000
+            try:
+                self.metrics.record(self.run_id, self.button, stage, model, latency_ms, usage, image_size, image_quality, self.attempt, cache_hit, error)
+            except sqlite3.Error as e:
+                self.warning.emit(f"Could not record metrics: {str(e)}")
+
+    def download_image(self, image_url):
+        try:
+            response = requests.get(image_url)
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as e:
+            print(f"RequestException downloading image: {e}")
+            return None
 
     def save_image(image_url, save_path):
         image_response = requests.get(image_url)
@@ -140,19 +361,61 @@ class QuickActionThread(QThread):
         return save_path
 
     def generate_unity_scripts(self, game_concept, character_concepts, world_concept):
-        scripts = {}
         descriptions = [
             f"Unity script for the player character in a 2D game with WASD controls and space bar to jump or shoot, based on the character descriptions: {character_concepts}",
             f"Unity script for an enemy character in a 2D game with basic AI behavior, based on the character descriptions: {character_concepts}",
-            f"Unity script for a game object in a 2D game, based on the world concept: {world_concept}",
-            f"Unity script for a second game object in a 2D game, based on the world concept: {world_concept}",
-            f"Unity script for a third game object in a 2D game, based on the world concept: {world_concept}",
+            f"Unity script for a collectible pickup game object in a 2D game, based on the world concept: {world_concept}",
+            f"Unity script for a hazard or obstacle game object in a 2D game, based on the world concept: {world_concept}",
+            f"Unity script for an interactive game object such as a door, switch or checkpoint in a 2D game, based on the world concept: {world_concept}",
             f"Unity script for the level background in a 2D game, based on the world concept: {world_concept}"
         ]
-        for i, desc in enumerate(descriptions, start=1):
-            scripts[f"script_{i}.cs"] = self.generate_content(desc)
+        with ThreadPoolExecutor(max_workers=UNITY_SCRIPT_WORKERS) as executor:
+            futures = [executor.submit(self.generate_unity_script, desc) for desc in descriptions]
+
+        scripts = {}
+        digests = set()
+        for i, future in enumerate(futures, start=1):
+            try:
+                code = future.result()
+            except GenerationError as e:
+                self.warning.emit(f"Error generating script {i}: {str(e)}")
+                continue
+            digest = script_digest(code)
+            if digest in digests:
+                self.warning.emit(f"Script {i} duplicates an earlier script, skipping it.")
+                continue
+            digests.add(digest)
+            # Stored as bytes so create_zip writes real .cs files
+            file_name, code = name_script(code, i, scripts)
+            scripts[file_name] = code.encode("utf-8")
+        if not scripts:
+            raise GenerationError("No Unity scripts could be generated.")
         return scripts
 
+    def generate_unity_script(self, description):
+        prompt = UNITY_SCRIPT_PROMPT.format(description=description)
+        cache_key = hashlib.sha256(f"gpt-4\n{self.action}\n{prompt}".encode("utf-8")).hexdigest()
+        cache_path = os.path.join(UNITY_SCRIPT_CACHE_DIR, f"{cache_key}.cs")
+        started = time.perf_counter()
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as file:
+                code = file.read()
+            self.record_call(self.stage, "gpt-4", started, cache_hit=True)
+            return code
+
+        content = self.generate_content(prompt)
+        code = extract_code(content)
+        if code is None:
+            # Replies without a code block are refusals or prose, not a script to ship as a .cs file
+            raise GenerationError("Reply had no C# code block.")
+        os.makedirs(UNITY_SCRIPT_CACHE_DIR, exist_ok=True)
+        # Written beside the entry and renamed into place, so a crash mid-write never leaves a truncated script to be served
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(code)
+        os.replace(temp_path, cache_path)
+        return code
+
     def create_master_document(self, game_plan):
         master_doc = "Game Plan Master Document\n\n"
         for key, value in game_plan.items():
@@ -187,23 +450,81 @@ class QuickActionThread(QThread):
         self.progress.emit(100, "ZIP package created.")
         return zip_buffer.read()
 
+class RefineImagesThread(QuickActionThread):
+    def __init__(self, action, bundle, image_requests, selected, metrics=None, credentials=None, parent=None):
+        super().__init__(action, "", metrics=metrics, credentials=credentials, parent=parent)
+        self.bundle = bundle
+        self.image_requests = image_requests
+        self.selected = selected
+
+    def run(self):
+        try:
+            for i, (group, name) in enumerate(self.selected):
+                self.progress.emit(i * 90 // len(self.selected), f"Refining {group}/{name} in HD...")
+                prompt, size = self.image_requests[(group, name)]
+                image_url = self.generate_image(prompt, size, FINAL_IMAGE_QUALITY, stage=f"refine_{group}")
+                image_data = self.download_image(image_url) if image_url else None
+                if image_data:
+                    self.bundle[group][name] = image_data
+                    self.preview.emit(f"{group}/{name}", image_data)
+                    del self.image_requests[(group, name)]
+                else:
+                    self.warning.emit(f"Could not refine {group}/{name}, keeping the draft.")
+
+            self.zip_data = self.create_zip(self.bundle)
+            self.finished.emit(f"{self.action}.zip")
+        except Exception as e:
+            self.finished.emit(f"Error: {str(e)}")
+
+class ConceptPrefetchThread(QuickActionThread):
+    def __init__(self, action, prompt, metrics=None, credentials=None, parent=None):
+        super().__init__(action, prompt, metrics=metrics, credentials=credentials, parent=parent)
+        # Speculative spend is reported apart from the bundles it ends up feeding
+        self.button = f"{action} (prefetch)"
+        self.concept = None
+
+    def run(self):
+        try:
+            self.concept = self.generate_content(CONCEPT_PROMPT.format(user_prompt=self.prompt), stage="game_concept")
+        except GenerationError:
+            self.concept = None
+
+class PreviewSignals(QObject):
+    decoded = pyqtSignal(str, QImage)
+
+class PreviewDecoder(QRunnable):
+    # Decodes and downscales an image on the thread pool; QImage, unlike QPixmap, is safe to build off the GUI thread
+    def __init__(self, name, data):
+        super().__init__()
+        self.name = name
+        self.data = data
+        self.signals = PreviewSignals()
+
+    def run(self):
+        try:
+            with Image.open(BytesIO(self.data)) as image:
+                image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+                image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), reducing_gap=2.0)
+                thumbnail = image.convert("RGBA")
+        except Exception:
+            return
+        preview = QImage(thumbnail.tobytes("raw", "RGBA"), thumbnail.width, thumbnail.height, QImage.Format_RGBA8888).copy()
+        self.signals.decoded.emit(self.name, preview)
+
 class QuickActionsApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Quick Actions")
 
-        self.api_key = self.load_api_key()
-        if not self.api_key:
-            self.api_key = self.ask_api_key()
-            if not self.api_key:
+        self.credentials = load_credential_pool()
+        if not self.credentials:
+            api_key = self.ask_api_key()
+            if not api_key:
                 QMessageBox.critical(self, "Error", "API key is required to proceed.")
                 sys.exit()
+            self.credentials = CredentialPool([Credential(api_key)])
 
-        global HEADERS
-        HEADERS = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        self.metrics = MetricsStore()
 
         # Main layout
         self.main_widget = QWidget()
@@ -213,31 +534,74 @@ class QuickActionsApp(QMainWindow):
 
         self.prompt_label = QLabel("Enter topic/keywords:")
         self.prompt_entry = QLineEdit()
+        self.prompt_entry.textChanged.connect(self.handle_prompt_changed)
         self.main_layout.addWidget(self.prompt_label)
         self.main_layout.addWidget(self.prompt_entry)
 
+        self.stage_panel = QTreeWidget()
+        self.stage_panel.setHeaderLabels(["Stage", "Status", "Detail"])
+        self.stage_panel.setRootIsDecorated(False)
+        self.main_layout.addWidget(self.stage_panel)
+        self.stage_items = {}
+
+        self.preview_list = QListWidget()
+        self.preview_list.setViewMode(QListView.IconMode)
+        self.preview_list.setIconSize(QSize(PREVIEW_SIZE, PREVIEW_SIZE))
+        self.preview_list.setResizeMode(QListView.Adjust)
+        self.preview_list.setFixedHeight(PREVIEW_SIZE + 48)
+        self.main_layout.addWidget(self.preview_list)
+        self.preview_items = {}
+
         self.result_box = QTextEdit()
         self.result_box.setReadOnly(True)
         self.main_layout.addWidget(self.result_box)
 
+        self.activity_label = QLabel("")
+        self.main_layout.addWidget(self.activity_label)
+
         self.progress_bar = QProgressBar()
         self.main_layout.addWidget(self.progress_bar)
 
+        # Worker signals only record the latest state; the frame timer applies it to the widgets
+        self.pending_progress = None
+        self.pending_stages = {}
+        self.pending_previews = {}
+        self.pending_warnings = []
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(PROGRESS_FRAME_MS)
+        self.frame_timer.timeout.connect(self.apply_pending_updates)
+
+        self.draft_checkbox = QCheckBox("Draft mode (fast previews, refine selected images later)")
+        self.main_layout.addWidget(self.draft_checkbox)
+        self.draft_thread = None
+
+        self.prefetch_checkbox = QCheckBox("Speculative prefetch (start the concept while you type)")
+        self.prefetch_checkbox.toggled.connect(self.handle_prompt_changed)
+        self.main_layout.addWidget(self.prefetch_checkbox)
+        self.prefetch_thread = None
+        self.prefetch_threads = []
+        self.prefetch_capped = False
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(PREFETCH_DEBOUNCE_MS)
+        self.prefetch_timer.timeout.connect(self.start_prefetch)
+
         self.actions = [
             "game plan"
         ]
 
+        self.action_buttons = []
         for action in self.actions:
             button = QPushButton(f"Generate {action.capitalize()}")
             button.clicked.connect(lambda checked, a=action: self.handle_action(a))
             self.main_layout.addWidget(button)
+            self.action_buttons.append(button)
 
-    def load_api_key(self):
-        if os.path.exists(API_KEY_FILE):
-            with open(API_KEY_FILE, 'r') as file:
-                data = json.load(file)
-                return data.get('api_key')
-        return None
+        self.refine_button = QPushButton("Refine Selected Images to HD")
+        self.refine_button.setEnabled(False)
+        self.refine_button.clicked.connect(self.handle_refine)
+        self.main_layout.addWidget(self.refine_button)
 
     def ask_api_key(self):
         api_key, ok = QInputDialog.getText(self, "API Key", "Please enter your OpenAI API key:", QLineEdit.Password)
@@ -247,31 +611,171 @@ class QuickActionsApp(QMainWindow):
             return api_key
         return None
 
+    def handle_prompt_changed(self):
+        self.prefetch_timer.stop()
+        # A request in flight cannot be aborted, so a stale prefetch is simply dropped and its result ignored
+        if self.prefetch_thread and self.prefetch_thread.prompt != self.prompt_entry.text():
+            self.prefetch_thread = None
+        if self.prefetch_checkbox.isChecked():
+            self.prefetch_timer.start()
+
+    def start_prefetch(self):
+        prompt = self.prompt_entry.text()
+        if not prompt.strip() or self.prefetch_thread:
+            return
+        if self.prefetch_spend() >= PREFETCH_SPEND_CAP:
+            if not self.prefetch_capped:
+                self.result_box.append("Speculative prefetch spend cap reached for this session.")
+                self.prefetch_capped = True
+            return
+        # Parented to the window so Qt keeps the thread alive after it is dropped
+        self.prefetch_thread = ConceptPrefetchThread(self.actions[0], prompt, metrics=self.metrics, credentials=self.credentials, parent=self)
+        self.prefetch_threads.append(self.prefetch_thread)
+        self.prefetch_thread.start()
+
+    def prefetch_spend(self):
+        # Stale prefetches still bill even though their results are dropped; those in flight count at an estimate
+        estimate = call_cost("gpt-4", PREFETCH_ESTIMATED_USAGE)
+        return sum(thread.spend if thread.isFinished() else estimate for thread in self.prefetch_threads)
+
     def handle_action(self, action):
         prompt = self.prompt_entry.text()
         self.result_box.append(f"Generating {action}...")
         self.progress_bar.setValue(0)
-        self.quick_action_thread = QuickActionThread(action, prompt)
-        self.quick_action_thread.progress.connect(self.update_progress)
-        self.quick_action_thread.finished.connect(self.handle_finished)
+        self.refine_button.setEnabled(False)
+        self.stage_panel.clear()
+        self.stage_items = {}
+        self.preview_list.clear()
+        self.preview_items = {}
+        self.quick_action_thread = QuickActionThread(action, prompt, draft=self.draft_checkbox.isChecked(), metrics=self.metrics, prefetch=self.prefetch_thread, credentials=self.credentials, parent=self)
+        # A prefetched concept feeds one run only, so generating again with the same prompt asks for a fresh concept
+        self.prefetch_thread = None
+        self.connect_thread(self.quick_action_thread)
+        self.quick_action_thread.start()
+        self.set_busy(True)
+
+    def connect_thread(self, thread):
+        thread.progress.connect(self.update_progress)
+        thread.stage_status.connect(self.update_stage)
+        thread.preview.connect(self.decode_preview)
+        thread.warning.connect(self.queue_warning)
+        # Bound to the thread that emits it, so the result is read from the run that produced it
+        thread.finished.connect(lambda filename_or_error, thread=thread: self.handle_finished(thread, filename_or_error))
+
+    def set_busy(self, busy):
+        # One run at a time: the shared bundle and refine state belong to the thread that is running
+        for button in self.action_buttons:
+            button.setEnabled(not busy)
+
+    def handle_refine(self):
+        if not self.draft_thread or not self.draft_thread.image_requests:
+            self.result_box.append("No draft images left to refine.")
+            return
+        selected = self.select_images(list(self.draft_thread.image_requests))
+        if not selected:
+            return
+        self.result_box.append(f"Refining {len(selected)} image(s) in HD...")
+        self.progress_bar.setValue(0)
+        self.refine_button.setEnabled(False)
+        self.quick_action_thread = RefineImagesThread(self.draft_thread.action, self.draft_thread.bundle, self.draft_thread.image_requests, selected, metrics=self.metrics, credentials=self.credentials, parent=self)
+        self.connect_thread(self.quick_action_thread)
         self.quick_action_thread.start()
+        self.set_busy(True)
+
+    def select_images(self, image_keys):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Refine Images")
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel("Select the draft images to regenerate in HD:"))
+        image_list = QListWidget()
+        image_list.setSelectionMode(QAbstractItemView.MultiSelection)
+        for group, name in image_keys:
+            image_list.addItem(f"{group}/{name}")
+        layout.addWidget(image_list)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout.addWidget(buttons)
+        if dialog.exec_() != QDialog.Accepted:
+            return []
+        return [image_keys[image_list.row(item)] for item in image_list.selectedItems()]
 
     def update_progress(self, value, message):
-        self.progress_bar.setValue(value)
-        self.result_box.append(message)
-
-    def handle_finished(self, zip_data, filename_or_error):
-        if zip_data:
+        self.pending_progress = (value, message)
+        self.schedule_frame()
+
+    def update_stage(self, stage, status, detail):
+        self.pending_stages[stage] = (status, detail)
+        self.schedule_frame()
+
+    def decode_preview(self, name, data):
+        decoder = PreviewDecoder(name, data)
+        decoder.signals.decoded.connect(self.queue_preview)
+        QThreadPool.globalInstance().start(decoder)
+
+    def queue_preview(self, name, image):
+        self.pending_previews[name] = image
+        self.schedule_frame()
+
+    def queue_warning(self, message):
+        self.pending_warnings.append(message)
+        self.schedule_frame()
+
+    def schedule_frame(self):
+        if not self.frame_timer.isActive():
+            self.frame_timer.start()
+
+    def apply_pending_updates(self):
+        if self.pending_progress:
+            value, message = self.pending_progress
+            self.progress_bar.setValue(value)
+            self.activity_label.setText(message)
+        for stage, (status, detail) in self.pending_stages.items():
+            if stage not in self.stage_items:
+                self.stage_items[stage] = QTreeWidgetItem(self.stage_panel, [stage.replace('_', ' ').capitalize(), "", ""])
+            self.stage_items[stage].setText(1, status)
+            self.stage_items[stage].setText(2, detail)
+        for name, image in self.pending_previews.items():
+            if name not in self.preview_items:
+                self.preview_items[name] = QListWidgetItem(name, self.preview_list)
+            self.preview_items[name].setIcon(QIcon(QPixmap.fromImage(image)))
+        if self.pending_warnings:
+            self.result_box.append("\n".join(self.pending_warnings))
+        self.pending_progress = None
+        self.pending_stages = {}
+        self.pending_previews = {}
+        self.pending_warnings = []
+
+    def handle_finished(self, thread, filename_or_error):
+        self.apply_pending_updates()
+        self.set_busy(False)
+        if isinstance(thread, RefineImagesThread) or thread.draft:
+            if self.draft_thread and self.draft_thread is not thread:
+                self.draft_thread.deleteLater()
+            self.draft_thread = thread if thread.bundle else None
+            self.refine_button.setEnabled(bool(self.draft_thread and self.draft_thread.image_requests))
+        if thread.failures:
+            self.result_box.append(thread.failure_report())
+        if thread.zip_data:
             options = QFileDialog.Options()
             file_path, _ = QFileDialog.getSaveFileName(self, "Save ZIP", "", "Zip Files (*.zip);;All Files (*)", options=options)
             if file_path:
                 with open(file_path, 'wb') as file:
-                    file.write(zip_data)
+                    file.write(thread.zip_data)
             self.result_box.append(f"{filename_or_error} generated and saved.")
         else:
             self.result_box.append(filename_or_error)
+        # The window owns its worker threads, so each is released once nothing needs its result;
+        # finished is emitted from the end of run(), so wait for run() to return before deleting
+        if thread is not self.draft_thread:
+            thread.wait()
+            thread.deleteLater()
 
 if __name__ == "__main__":
+    if "--report" in sys.argv:
+        print(MetricsStore().report())
+        sys.exit()
+
     app = QApplication(sys.argv)
     window = QuickActionsApp()
     window.show()